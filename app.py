@@ -1,28 +1,79 @@
 from __future__ import annotations
 
 import calendar
+import hashlib
+import hmac
 import json
+import math
+import os
+import queue
 import random
-import re
+import shutil
 import sqlite3
-from datetime import date, datetime, timedelta
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from functools import lru_cache, wraps
 from io import BytesIO
 from pathlib import Path
+import click
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, flash, g, jsonify, send_file
+    url_for, session, flash, g, jsonify, send_file, has_request_context
 )
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
+from jinja2.utils import htmlsafe_json_dumps
 from werkzeug.routing import BuildError
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # --- Swagger Integration ---
 from flasgger import Swagger, swag_from
 
+# --- JSON veloce (orjson se installato, altrimenti stdlib) ---
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    orjson = None
+
+if orjson is not None:
+    # chiavi non stringa (es. int) convertite come fa json.dumps, invece di sollevare TypeError
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=_ORJSON_OPTS).decode("utf-8")
+    _json_loads = orjson.loads
+
+    class _OrjsonProvider(DefaultJSONProvider):
+        """jsonify/tojson su orjson; date, Decimal ecc. passano dal default di Flask come prima."""
+
+        def dumps(self, obj, **kwargs) -> str:
+            option = orjson.OPT_PASSTHROUGH_DATETIME | _ORJSON_OPTS
+            if kwargs.get("sort_keys", self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode("utf-8")
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+else:  # pragma: no cover
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+_EMPTY_PAYLOAD_JSON = "{}"
+
 # --- Application Configuration ---
 app = Flask(__name__, instance_relative_config=True)
 app.config['SECRET_KEY'] = 'cambia-questa-secret-in-prod'  # usa una env var in prod
 app.config['DATABASE'] = str(Path(app.instance_path) / 'app.db')
+app.config['DATABASE_POOL_SIZE'] = 2 * (os.cpu_count() or 1)
+if orjson is not None:
+    app.json = _OrjsonProvider(app)
+# le risposte escono con le chiavi nell'ordine di costruzione: niente sort per ogni dict serializzato
+app.json.sort_keys = False
 
 # Swagger config minimale
 app.config['SWAGGER'] = {
@@ -34,20 +85,223 @@ swagger = Swagger(app)
 # Assicura la cartella instance/ esista
 Path(app.instance_path).mkdir(parents=True, exist_ok=True)
 
+# Template compilati salvati su disco: dopo un riavvio i worker caricano il bytecode invece di
+# ricompilare i sorgenti (Jinja lo invalida da sé se il template cambia).
+_jinja_cache_dir = Path(app.instance_path) / "jinja_cache"
+_jinja_cache_dir.mkdir(exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(_jinja_cache_dir))
+
 
 # --- Database Helpers ---
+# PRAGMA eseguite una sola volta all'apertura di ogni connessione
+_CONNECTION_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA foreign_keys = ON;
+PRAGMA temp_store = MEMORY;
+PRAGMA mmap_size = 268435456;
+PRAGMA cache_size = -64000;
+PRAGMA busy_timeout = 5000;
+"""
+
+# Statement SQL eseguiti più spesso: testo identico ad ogni chiamata, così la
+# cache degli statement di sqlite3 (chiave = testo SQL) evita il re-parsing.
+_STATEMENT_CACHE_SIZE = 256
+
+_SQL_NEXT_ID = "UPDATE id_counters SET last_id = last_id + 1 WHERE prefix = ? RETURNING last_id"
+
+_SQL_INSERT_TX = """
+    INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_PIGGY_TRANSFER = """
+    INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Come sopra, ma inserisce solo se il saldo in centesimi più la variazione con segno resta >= 0:
+# verifica e scrittura in un solo statement, senza rileggere current_amount da Python
+_SQL_INSERT_PIGGY_TRANSFER_GUARDED = """
+    INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
+    SELECT ?, piggy_id, ?, ?, ?, ?, ?
+    FROM piggy_banks
+    WHERE piggy_id = ? AND user_id = ? AND status != 'DELETED'
+      AND CAST(ROUND(COALESCE(current_amount, 0) * 100) AS INTEGER) + ? >= 0
+"""
+
+_SQL_DELETE_PIGGY_TRANSFERS_SINCE = """
+    DELETE FROM piggy_transfers WHERE account_id = ? AND date >= ? AND direction = ?
+"""
+
+# Messaggio di RAISE(ABORT) del trigger trg_piggy_banks_non_negative (schema.sql)
+_PIGGY_NEGATIVE_BALANCE = "saldo salvadanaio insufficiente"
+
+# Saldo di un salvadanaio attivo solo se appartiene all'utente: verifica di proprietà e lettura insieme
+_SQL_OWNED_PIGGY_BALANCE = """
+    SELECT COALESCE(current_amount, 0) FROM piggy_banks
+    WHERE piggy_id = ? AND user_id = ? AND status != 'DELETED'
+"""
+
+# Chiusura (soft delete, evita problemi di FK) condivisa da /piggy/delete e DELETE /api/piggy/<id>
+_SQL_SOFT_DELETE_PIGGY = "UPDATE piggy_banks SET status = 'DELETED' WHERE piggy_id = ?"
+
+# Varianti idempotenti per chi fornisce l'ID (seed, API con transfer_id esplicito)
+_SQL_INSERT_TX_IF_NEW = """
+    INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(transaction_id) DO NOTHING
+"""
+
+_SQL_INSERT_PIGGY_TRANSFER_IF_NEW = """
+    INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(transfer_id) DO NOTHING
+"""
+
+_SQL_INSERT_PIGGY = """
+    INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
+    VALUES (?, ?, ?, ?, 0, 'ACTIVE')
+"""
+
+_SQL_INSERT_P2P = """
+    INSERT INTO p2p_transfers (p2p_id, from_user_id, to_user_id, from_account_id, to_account_id, amount, message)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_NOTIFICATION = """
+    INSERT INTO notifications (notification_id, user_id, type, title, body, status, dedupe_key, payload)
+    VALUES (?, ?, ?, ?, ?, 'UNREAD', ?, ?)
+"""
+
+# stessa INSERT, ma una dedupe_key già presente per l'utente aggiorna la notifica esistente
+# (poggia sull'indice univoco uq_notifications_user_dedupe)
+_SQL_UPSERT_NOTIFICATION = _SQL_INSERT_NOTIFICATION + """
+    ON CONFLICT(user_id, dedupe_key) DO UPDATE SET
+        body = COALESCE(excluded.body, body),
+        payload = excluded.payload,
+        created_at = CASE WHEN status = 'UNREAD' THEN datetime('now') ELSE created_at END
+    RETURNING notification_id
+"""
+
+_SQL_LIST_NOTIFICATIONS = """
+    SELECT notification_id, type, title, body, status, payload, created_at, read_at
+    FROM notifications
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+
+# come _SQL_LIST_NOTIFICATIONS più il totale delle non lette (la finestra è calcolata prima del LIMIT)
+_SQL_LIST_NOTIFICATIONS_WITH_UNREAD = """
+    SELECT notification_id, type, title, body, status, payload, created_at, read_at,
+           COUNT(*) FILTER (WHERE status = 'UNREAD') OVER () AS unread
+    FROM notifications
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+
+_SQL_LIST_NOTIFICATIONS_BY_STATUS = """
+    SELECT notification_id, type, title, body, status, payload, created_at, read_at
+    FROM notifications
+    WHERE user_id = ? AND status = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+
+# come _SQL_LIST_NOTIFICATIONS_BY_STATUS più il totale delle non lette (subquery scalare, valutata una volta)
+_SQL_LIST_NOTIFICATIONS_BY_STATUS_WITH_UNREAD = """
+    SELECT notification_id, type, title, body, status, payload, created_at, read_at,
+           (SELECT COUNT(*) FROM notifications WHERE user_id = ?1 AND status = 'UNREAD') AS unread
+    FROM notifications
+    WHERE user_id = ?1 AND status = ?2
+    ORDER BY created_at DESC
+    LIMIT ?3
+"""
+
+# Pool di connessioni riutilizzate tra le richieste web: (percorso db, connessione)
+_db_pool: queue.LifoQueue = queue.LifoQueue(maxsize=app.config['DATABASE_POOL_SIZE'])
+
+
+def _close_connection(conn: sqlite3.Connection) -> None:
+    """Chiude una connessione lasciando a SQLite l'aggiornamento delle statistiche che ne hanno bisogno."""
+    try:
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+
+
+def _open_connection(database: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(database, check_same_thread=False, cached_statements=_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_CONNECTION_PRAGMAS)
+    return conn
+
+
+def _acquire_connection(database: str) -> sqlite3.Connection:
+    """Preleva una connessione dal pool (o ne apre una nuova se il pool è vuoto)."""
+    while True:
+        try:
+            path, conn = _db_pool.get_nowait()
+        except queue.Empty:
+            return _open_connection(database)
+        if path == database:
+            return conn
+        _close_connection(conn)  # connessione verso un database non più configurato
+
+
+def _release_connection(database: str, conn: sqlite3.Connection) -> None:
+    """Restituisce la connessione al pool scartando eventuali transazioni rimaste aperte."""
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait((database, conn))
+    except queue.Full:
+        _close_connection(conn)
+
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA foreign_keys = ON;")
+        database = app.config['DATABASE']
+        # le richieste web usano il pool, i comandi CLI una connessione dedicata
+        if has_request_context():
+            g.db = _acquire_connection(database)
+            g.db_pool_key = database
+        else:
+            g.db = _open_connection(database)
     return g.db
 
 @app.teardown_appcontext
 def close_db(_exc):
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if db is None:
+        return
+    pool_key = g.pop('db_pool_key', None)
+    if pool_key is not None:
+        _release_connection(pool_key, db)
+    else:
+        _close_connection(db)
+
+def _fetch_dicts(sql: str, params=(), *, db: sqlite3.Connection | None = None) -> list[dict]:
+    """Righe come dict pronte per le risposte JSON: cursore a tuple, nomi colonna letti una volta
+    da cursor.description invece che da ogni sqlite3.Row. Il cursore è consumato direttamente,
+    senza la lista intermedia di tuple di fetchall()."""
+    cur = (db or get_db()).cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    keys = [col[0] for col in cur.description]
+    return [dict(zip(keys, row)) for row in cur]
+
+def _json_rows(sql: str, params=()):
+    """Risposta JSON di una query elenco: lista di oggetti, oppure con ?format=columns il formato
+    colonnare {"columns": [...], "rows": [[...], ...]} che serializza le tuple senza un dict per riga."""
+    if request.args.get("format") != "columns":
+        return jsonify(_fetch_dicts(sql, params))
+    cur = get_db().cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    return jsonify({"columns": [col[0] for col in cur.description], "rows": cur.fetchall()})
 
 def exec_script(sql_text: str):
     db = get_db()
@@ -55,27 +309,156 @@ def exec_script(sql_text: str):
     db.commit()
 
 
-# --- Identifier & Movement Helpers ---
-def _next_id(prefix: str, table: str, col: str) -> str:
-    """Genera ID testuale incrementale, es. PIG001 → PIG002, gestendo correttamente 3/4/5+ cifre."""
+@contextmanager
+def _bulk_write():
+    """Esegue i seed in un'unica transazione con synchronous=OFF (nessun fsync intermedio).
+
+    Anche secure_delete è spento: i seed cancellano e riscrivono dati demo, inutile azzerare
+    le pagine liberate. Pensato per i comandi CLI: un seed interrotto viene annullato per intero.
+    """
     db = get_db()
+    db.commit()  # synchronous non si può cambiare dentro una transazione
+    secure_delete = db.execute("PRAGMA secure_delete").fetchone()[0]
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA secure_delete = OFF")
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute(f"PRAGMA secure_delete = {int(secure_delete)}")
+    # dopo un seed le tabelle cambiano di ordini di grandezza: statistiche nuove per il planner
+    db.execute("ANALYZE")
+
+
+# Tentativi di BEGIN IMMEDIATE quando un altro writer tiene il lock oltre busy_timeout
+_WRITE_TX_RETRIES = 5
+
+
+@contextmanager
+def _write_tx(db: sqlite3.Connection | None = None, *, retries: int = _WRITE_TX_RETRIES):
+    """Transazione di scrittura che prende subito il lock (BEGIN IMMEDIATE), poi commit o rollback.
+
+    Con il begin lazy un lettore che diventa writer può ricevere SQLITE_BUSY a metà lavoro;
+    prendendo il lock in testa l'unico punto di attesa è il BEGIN, ritentato con backoff.
+    Se il chiamante ha già una transazione aperta vi si partecipa: commit/rollback restano suoi.
+    """
+    db = db or get_db()
+    if db.in_transaction:
+        yield db
+        return
+    for attempt in range(retries):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == retries - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+# --- Identifier & Movement Helpers ---
+_CENT = Decimal("1")
+
+
+def _to_cents(value) -> int:
+    """Converte un importo (float/str/Decimal) in centesimi interi, arrotondando a metà verso l'alto.
+
+    I confronti sui saldi avvengono in centesimi: niente epsilon sui float. Valori non numerici
+    o non finiti (inf, nan, 1e400 letto come float) sollevano ValueError, che le route rendono 400.
+    """
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError("Importo non valido") from None
+    if not amount.is_finite():
+        raise ValueError("Importo non valido")
+    return int(amount.scaleb(2).quantize(_CENT, rounding=ROUND_HALF_UP))
+
+def _today_iso() -> str:
+    """Data odierna "YYYY-MM-DD", calcolata una volta per richiesta (fuori richiesta ogni volta)."""
+    if not has_request_context():
+        return date.today().isoformat()
+    if "today_iso" not in g:
+        g.today_iso = date.today().isoformat()
+    return g.today_iso
+
+def _scan_last_id(prefix: str, table: str, col: str, *, db: sqlite3.Connection | None = None) -> int:
+    """Ultimo numero usato per il prefisso ricavato dalla tabella (usato solo per inizializzare il contatore)."""
+    db = db or get_db()
     row = db.execute(
         f"""
         SELECT {col} AS id
         FROM {table}
-        WHERE {col} LIKE ?
+        WHERE {col} GLOB ?
         ORDER BY LENGTH({col}) DESC, {col} DESC
         LIMIT 1
         """,
-        (f"{prefix}%",),
+        (f"{prefix}[0-9]*",),
     ).fetchone()
     if not row:
-        return f"{prefix}001"
-    m = re.search(r"(\d+)$", row["id"])
-    n = int(m.group(1)) + 1 if m else 1
+        return 0
+    # prefisso di lunghezza nota: il numero è il resto dell'ID (stessa regola di _sync_id_counter)
+    suffix = row["id"][len(prefix):]
+    return int(suffix) if suffix.isdigit() else 0
+
+def _next_id(prefix: str, table: str, col: str, *, db: sqlite3.Connection | None = None) -> str:
+    """Genera ID testuale incrementale, es. PIG001 → PIG002, gestendo correttamente 3/4/5+ cifre.
+
+    Il contatore per prefisso è in id_counters: la tabella viene scansionata solo la prima volta.
+    Chi ha già la connessione la passa in ``db`` (evita un lookup su ``g`` per ogni ID).
+    """
+    db = db or get_db()
+    rows = db.execute(_SQL_NEXT_ID, (prefix,)).fetchall()
+    if rows:
+        n = rows[0]["last_id"]
+    else:
+        n = db.execute(
+            """
+            INSERT INTO id_counters (prefix, last_id) VALUES (?, ?)
+            ON CONFLICT(prefix) DO UPDATE SET last_id = last_id + 1
+            RETURNING last_id
+            """,
+            (prefix, _scan_last_id(prefix, table, col, db=db) + 1),
+        ).fetchall()[0]["last_id"]
     return f"{prefix}{n:03d}"
 
+def _next_ids(prefix: str, table: str, col: str, count: int, *, db: sqlite3.Connection | None = None) -> list[str]:
+    """Riserva count ID consecutivi con un solo avanzamento del contatore."""
+    if count <= 0:
+        return []
+    db = db or get_db()
+    first = int(_next_id(prefix, table, col, db=db)[len(prefix):])
+    if count > 1:
+        db.execute("UPDATE id_counters SET last_id = last_id + ? WHERE prefix = ?", (count - 1, prefix))
+    return [f"{prefix}{n:03d}" for n in range(first, first + count)]
+
+def _sync_id_counter(prefix: str, ident: str, *, db: sqlite3.Connection | None = None) -> None:
+    """Allinea il contatore quando un ID con il prefisso viene inserito dall'esterno (es. TRP010)."""
+    suffix = str(ident)[len(prefix):]
+    if not str(ident).startswith(prefix) or not suffix.isdigit():
+        return
+    (db or get_db()).execute(
+        "UPDATE id_counters SET last_id = MAX(last_id, ?) WHERE prefix = ?",
+        (int(suffix), prefix),
+    )
+
 # --- Demo Entity Helpers ---
+# Hash delle password: scrypt (OpenSSL) con costo esplicito, N=2^15 r=8 p=1, lo stesso default
+# di Werkzeug 3 fissato qui perché non cambi con un aggiornamento. check_password_hash legge il
+# metodo dal prefisso dell'hash, quindi eventuali hash pbkdf2 già salvati restano validi.
+_PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+
 def _upsert_user(user_id: str, codice: str, first: str, last: str, pwd: str = "Password123!"):
     db = get_db()
     db.execute("""
@@ -86,7 +469,8 @@ def _upsert_user(user_id: str, codice: str, first: str, last: str, pwd: str = "P
           first_name     = excluded.first_name,
           last_name      = excluded.last_name,
           password_hash  = excluded.password_hash
-    """, (user_id, codice, first, last, generate_password_hash(pwd)))
+    """, (user_id, codice, first, last, generate_password_hash(pwd, method=_PASSWORD_HASH_METHOD)))
+    _invalidate_user_lookup()
 
 def _ensure_account(account_id: str, user_id: str, iban: str, name: str, currency: str = "EUR", balance: float = 0.0):
     db = get_db()
@@ -105,7 +489,7 @@ def _ensure_contact_for(owner_user_id: str, target_user_id: str, target_account_
     """, (owner_user_id, target_user_id, target_account_id)).fetchone()
     if exists:
         return
-    contact_id = _next_id("CON", "contacts", "contact_id")
+    contact_id = _next_id("CON", "contacts", "contact_id", db=db)
     db.execute("""
         INSERT INTO contacts (contact_id, owner_user_id, display_name, target_user_id, target_account_id)
         VALUES (?, ?, ?, ?, ?)
@@ -116,43 +500,24 @@ def _ensure_contact_for(owner_user_id: str, target_user_id: str, target_account_
 
 def _ensure_notification(*, user_id: str, type_: str, title: str,
                          body: str | None = None, dedupe_key: str | None = None,
-                         payload: dict | None = None) -> str:
-    db = get_db()
-    payload_json = json.dumps(payload or {})
+                         payload: dict | None = None,
+                         db: sqlite3.Connection | None = None, commit: bool = True) -> str:
+    """Crea la notifica o, se la dedupe_key esiste già per l'utente, la aggiorna (una sola UPSERT).
 
-    if dedupe_key:
-        existing = db.execute(
-            """
-            SELECT notification_id, status FROM notifications
-            WHERE user_id = ? AND dedupe_key = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-            """,
-            (user_id, dedupe_key),
-        ).fetchone()
-        if existing:
-            db.execute(
-                """
-                UPDATE notifications
-                SET body = COALESCE(?, body),
-                    payload = ?,
-                    created_at = CASE WHEN status = 'UNREAD' THEN datetime('now') ELSE created_at END
-                WHERE notification_id = ?
-                """,
-                (body, payload_json, existing["notification_id"]),
-            )
-            db.commit()
-            return existing["notification_id"]
+    In caso di conflitto l'ID riservato dal contatore resta inutilizzato: gli ID restano
+    crescenti ma possono avere buchi.
+    """
+    db = db or get_db()
+    payload_json = _json_dumps(payload) if payload else _EMPTY_PAYLOAD_JSON
+    notification_id = _next_id("NOT", "notifications", "notification_id", db=db)
+    params = (notification_id, user_id, type_, title, body, dedupe_key or None, payload_json)
 
-    notification_id = _next_id("NOT", "notifications", "notification_id")
-    db.execute(
-        """
-        INSERT INTO notifications (notification_id, user_id, type, title, body, status, dedupe_key, payload)
-        VALUES (?, ?, ?, ?, ?, 'UNREAD', ?, ?)
-        """,
-        (notification_id, user_id, type_, title, body, dedupe_key, payload_json),
-    )
-    db.commit()
+    if dedupe_key:
+        notification_id = db.execute(_SQL_UPSERT_NOTIFICATION, params).fetchall()[0][0]
+    else:
+        db.execute(_SQL_INSERT_NOTIFICATION, params)
+    if commit:
+        db.commit()
     return notification_id
 
 
@@ -171,35 +536,122 @@ def _clear_notification_by_dedupe(*, user_id: str, dedupe_key: str) -> None:
     db.commit()
 
 
-def _list_notifications(user_id: str, limit: int = 10, status: str | None = None) -> list[sqlite3.Row]:
-    db = get_db()
-    params = [user_id]
-    where = ["user_id = ?"]
-    if status in {"UNREAD", "READ"}:
-        where.append("status = ?")
-        params.append(status)
-    sql = f"""
-        SELECT notification_id, type, title, body, status, payload, created_at, read_at
-        FROM notifications
-        WHERE {' AND '.join(where)}
-        ORDER BY created_at DESC
-        LIMIT ?
+def _sync_piggy_target_notifications(user_id: str, piggies: list[dict], *,
+                                     db: sqlite3.Connection | None = None) -> None:
+    """Allinea le notifiche PIGGY_TARGET di tutti i salvadanai con una lettura e scritture in blocco.
+
+    Stesse regole di _ensure_notification/_clear_notification_by_dedupe applicate per salvadanaio:
+    target raggiunto -> crea o aggiorna la notifica, altrimenti la segna come letta.
     """
-    params.append(limit)
-    rows = db.execute(sql, params).fetchall()
-    result = []
-    for row in rows:
-        payload = row["payload"]
+    if not piggies:
+        return
+    db = db or get_db()
+    existing: dict[str, str] = {}   # dedupe_key -> notification_id più recente
+    unread: set[str] = set()
+    for row in db.execute(
+        """
+        SELECT notification_id, dedupe_key, status FROM notifications
+        WHERE user_id = ? AND dedupe_key LIKE 'piggy:target:%'
+        ORDER BY created_at ASC
+        """,
+        (user_id,),
+    ):
+        existing[row["dedupe_key"]] = row["notification_id"]
+        if row["status"] == 'UNREAD':
+            unread.add(row["dedupe_key"])
+
+    inserts, updates, clears = [], [], []
+    for piggy in piggies:
+        key = f"piggy:target:{piggy['piggy_id']}"
+        target = piggy['target_amount']
+        current = float(piggy['current_amount'] or 0.0)
+        if target and _to_cents(current) >= _to_cents(target):
+            body = f"Hai accumulato {current:.2f}€ su un target di {float(target):.2f}€."
+            payload_json = _json_dumps({'piggy_id': piggy['piggy_id'], 'current': current, 'target': float(target)})
+            if key in existing:
+                updates.append((body, payload_json, existing[key]))
+            else:
+                inserts.append((user_id, 'PIGGY_TARGET', f"Obiettivo '{piggy['name']}' raggiunto",
+                                body, key, payload_json))
+        elif key in unread:
+            clears.append((user_id, key))
+
+    if not (inserts or updates or clears):
+        return
+    if updates:
+        db.executemany(
+            """
+            UPDATE notifications
+            SET body = COALESCE(?, body),
+                payload = ?,
+                created_at = CASE WHEN status = 'UNREAD' THEN datetime('now') ELSE created_at END
+            WHERE notification_id = ?
+            """,
+            updates,
+        )
+    if inserts:
+        ids = _next_ids("NOT", "notifications", "notification_id", len(inserts), db=db)
+        db.executemany(_SQL_INSERT_NOTIFICATION, [(nid, *row) for nid, row in zip(ids, inserts)])
+    if clears:
+        db.executemany(
+            """
+            UPDATE notifications
+            SET status = 'READ', read_at = datetime('now')
+            WHERE user_id = ? AND dedupe_key = ? AND status = 'UNREAD'
+            """,
+            clears,
+        )
+    db.commit()
+
+
+def _list_notifications(user_id: str, limit: int = 10, status: str | None = None,
+                        *, db: sqlite3.Connection | None = None) -> list[sqlite3.Row]:
+    db = db or get_db()
+    if status in {"UNREAD", "READ"}:
+        rows = db.execute(_SQL_LIST_NOTIFICATIONS_BY_STATUS, (user_id, status, limit)).fetchall()
+    else:
+        rows = db.execute(_SQL_LIST_NOTIFICATIONS, (user_id, limit)).fetchall()
+    return [_notification_dict(row) for row in rows]
+
+
+def _list_notifications_with_unread(user_id: str, limit: int = 10, status: str | None = None,
+                                    *, db: sqlite3.Connection | None = None) -> tuple[list[dict], int]:
+    """Notifiche più recenti e totale non lette nella stessa query (colonna 8 di ogni riga)."""
+    db = db or get_db()
+    if status in {"UNREAD", "READ"}:
+        rows = db.execute(_SQL_LIST_NOTIFICATIONS_BY_STATUS_WITH_UNREAD, (user_id, status, limit)).fetchall()
+        if not rows and status == "READ":
+            # nessuna riga da cui leggere il totale: serve il COUNT a parte
+            return [], _count_unread_notifications(user_id, db=db)
+    else:
+        rows = db.execute(_SQL_LIST_NOTIFICATIONS_WITH_UNREAD, (user_id, limit)).fetchall()
+    return [_notification_dict(row) for row in rows], (rows[0][8] if rows else 0)
+
+
+def _notification_dict(row: sqlite3.Row) -> dict:
+    # accesso posizionale nell'ordine delle colonne di _SQL_LIST_NOTIFICATIONS*
+    payload = row[5]
+    if not payload or payload == _EMPTY_PAYLOAD_JSON:
+        payload_data = {}
+    else:
         try:
-            payload_data = json.loads(payload) if payload else {}
-        except json.JSONDecodeError:
+            payload_data = _json_loads(payload)
+        except json.JSONDecodeError:  # orjson.JSONDecodeError ne è sottoclasse
             payload_data = {"raw": payload}
-        result.append({**dict(row), "payload": payload_data})
-    return result
+    return {
+        "notification_id": row[0],
+        "type": row[1],
+        "title": row[2],
+        "body": row[3],
+        "status": row[4],
+        "payload": payload_data,
+        "created_at": row[6],
+        "read_at": row[7],
+    }
 
 
-def _count_unread_notifications(user_id: str) -> int:
-    db = get_db()
+def _count_unread_notifications(user_id: str, *, db: sqlite3.Connection | None = None) -> int:
+    db = db or get_db()
     row = db.execute(
         "SELECT COUNT(1) AS cnt FROM notifications WHERE user_id = ? AND status = 'UNREAD'",
         (user_id,),
@@ -223,6 +675,13 @@ def _mark_notification(user_id: str, notification_id: str, status: str) -> bool:
     return res.rowcount > 0
 
 
+# preferenze di default per un utente che non le ha ancora (versione batch di _ensure_user_settings)
+_SQL_USER_SETTINGS_DEFAULTS = """
+    INSERT INTO user_settings (user_id) VALUES (?)
+    ON CONFLICT(user_id) DO NOTHING
+"""
+
+
 def _ensure_user_settings(user_id: str) -> sqlite3.Row:
     db = get_db()
     settings = db.execute(
@@ -235,23 +694,33 @@ def _ensure_user_settings(user_id: str) -> sqlite3.Row:
     ).fetchone()
     if settings:
         return settings
-    db.execute(
+    # percorso "freddo": inserisce i default e restituisce la riga in un solo statement
+    # (DO UPDATE no-op invece di DO NOTHING, così RETURNING produce la riga anche se
+    # un'altra richiesta l'ha appena creata). RETURNING restituisce il default 1.0 come intero,
+    # senza l'affinità REAL della colonna: il CAST lo riporta a 1.0 come il SELECT sopra.
+    settings = db.execute(
         """
         INSERT INTO user_settings (user_id, default_currency, decimal_places, notify_threshold)
         VALUES (?, 'EUR', 2, 1.0)
+        ON CONFLICT(user_id) DO UPDATE SET user_id = excluded.user_id
+        RETURNING user_id, default_currency, decimal_places, CAST(notify_threshold AS REAL) AS notify_threshold
         """,
         (user_id,),
-    )
+    ).fetchall()[0]
     db.commit()
-    return db.execute(
-        "SELECT user_id, default_currency, decimal_places, notify_threshold FROM user_settings WHERE user_id = ?",
-        (user_id,),
-    ).fetchone()
+    return settings
 
 
 def _get_user_settings(user_id: str) -> dict:
+    # memoizzate per richiesta come global_ctx (layout e pagina le leggono entrambi): nessuna
+    # cache di processo, quindi un salvataggio fatto da un altro worker si vede alla richiesta dopo
+    cached = g.get("user_settings")
+    if cached is not None and cached[0] == user_id:
+        return dict(cached[1])
     settings = _ensure_user_settings(user_id)
-    return dict(settings) if settings else {"user_id": user_id, "default_currency": "EUR", "decimal_places": 2, "notify_threshold": 1.0}
+    data = dict(settings) if settings else {"user_id": user_id, "default_currency": "EUR", "decimal_places": 2, "notify_threshold": 1.0}
+    g.user_settings = (user_id, data)
+    return dict(data)
 
 
 def _update_user_settings(user_id: str, *, default_currency: str, decimal_places: int, notify_threshold: float) -> dict:
@@ -283,6 +752,7 @@ def _update_user_settings(user_id: str, *, default_currency: str, decimal_places
         (user_id, currency, decimals, threshold),
     )
     db.commit()
+    g.pop("user_settings", None)
     return _get_user_settings(user_id)
 
 # --- Navigation Context ---
@@ -310,56 +780,77 @@ NAV_PRIMARY_LINKS = [
 
 @app.context_processor
 def inject_global_context():
-    if not session.get("user_id"):
+    user_id = session.get("user_id")
+    # calcolato una sola volta per richiesta (layout, partial e macro riusano lo stesso contesto)
+    cached = g.get("global_ctx")
+    if cached is not None and cached[0] == user_id:
+        return cached[1]
+    ctx = _build_global_context(user_id)
+    g.global_ctx = (user_id, ctx)
+    return ctx
+
+
+def _build_global_context(user_id: str | None) -> dict:
+    if not user_id:
         return {
             "nav_links": [],
         }
-    user_id = session["user_id"]
     settings = _get_user_settings(user_id)
     items = _list_notifications(user_id, limit=5)
     unread = sum(1 for note in items if note.get("status") == "UNREAD")
-    links = []
-    for item in NAV_PRIMARY_LINKS:
-        try:
-            link_url = url_for(item["endpoint"])
-        except BuildError:
-            link_url = None
-        links.append({
-            "label": item["label"],
-            "icon": item.get("icon"),
-            "endpoint": item["endpoint"],
-            "match": item.get("match", item["endpoint"]),
-            "url": link_url,
-        })
     return {
         "user_settings": settings,
         "nav_notifications": {
             "items": items,
             "unread": unread,
         },
-        "nav_links": links,
+        "nav_links": _nav_links(),
     }
 
+
+# URL della navigazione risolti al primo utilizzo (la mappa delle route non cambia a runtime)
+_NAV_LINKS_CACHE: list[dict] | None = None
+
+
+def _nav_links() -> list[dict]:
+    global _NAV_LINKS_CACHE
+    if _NAV_LINKS_CACHE is None:
+        links = []
+        for item in NAV_PRIMARY_LINKS:
+            try:
+                link_url = url_for(item["endpoint"])
+            except BuildError:
+                link_url = None
+            links.append({
+                "label": item["label"],
+                "icon": item.get("icon"),
+                "endpoint": item["endpoint"],
+                "match": item.get("match", item["endpoint"]),
+                "url": link_url,
+            })
+        _NAV_LINKS_CACHE = links
+    return _NAV_LINKS_CACHE
+
 # --- CLI Commands ---
 def _seed_additional_demo_users(*, owner_user_id: str, owner_account_id: str | None) -> list[str]:
     """Ensure extra demo users, accounts and reciprocal contacts exist."""
     db = get_db()
     owner = db.execute(
-        "SELECT user_id, first_name, last_name FROM users WHERE user_id = ?",
+        "SELECT user_id, display_name FROM users WHERE user_id = ?",
         (owner_user_id,),
     ).fetchone()
 
     if not owner and owner_user_id == "USE001":
         _upsert_user("USE001", "123456", "Emanuele", "Chiummo")
         owner = db.execute(
-            "SELECT user_id, first_name, last_name FROM users WHERE user_id = ?",
+            "SELECT user_id, display_name FROM users WHERE user_id = ?",
             (owner_user_id,),
         ).fetchone()
 
     if not owner:
         raise ValueError(f"Utente owner {owner_user_id} non trovato per il seeding demo.")
 
-    owner_name = f"{owner['first_name']} {owner['last_name']}".strip()
+    owner_name = owner["display_name"]
 
     users = [
         # USE002 potrebbe già esistere (seed-demo-p2p), la upsert lo gestisce
@@ -373,25 +864,50 @@ def _seed_additional_demo_users(*, owner_user_id: str, owner_account_id: str | N
              acc="ACC005", iban="IT60X0542811101000000005005", acc_name="Conto Chiara",   balance=2100.00),
     ]
 
-    for u in users:
-        _upsert_user(u["user_id"], u["codice"], u["first"], u["last"])
-        _ensure_account(u["acc"], u["user_id"], u["iban"], u["acc_name"], "EUR", u["balance"])
-
-    for u in users:
-        display = f"{u['first']} {u['last']}"
-        _ensure_contact_for(owner_user_id=owner_user_id,
-                            target_user_id=u["user_id"],
-                            target_account_id=u["acc"],
-                            display_name=display)
+    # il commit lo fa il comando CLI (_bulk_write)
+    db.executemany("""
+        INSERT INTO users (user_id, codice_cliente, first_name, last_name, password_hash)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          codice_cliente = excluded.codice_cliente,
+          first_name     = excluded.first_name,
+          last_name      = excluded.last_name,
+          password_hash  = excluded.password_hash
+    """, [(u["user_id"], u["codice"], u["first"], u["last"],
+           generate_password_hash("Password123!", method=_PASSWORD_HASH_METHOD))
+          for u in users])
+    _invalidate_user_lookup()
+    db.executemany("""
+        INSERT INTO accounts (account_id, user_id, iban, name, currency, balance)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(account_id) DO NOTHING
+    """, [(u["acc"], u["user_id"], u["iban"], u["acc_name"], "EUR", float(u["balance"])) for u in users])
 
+    wanted = [(owner_user_id, u["user_id"], u["acc"], f"{u['first']} {u['last']}") for u in users]
     if owner_account_id:
-        for u in users:
-            _ensure_contact_for(owner_user_id=u["user_id"],
-                                target_user_id=owner_user_id,
-                                target_account_id=owner_account_id,
-                                display_name=owner_name)
+        wanted += [(u["user_id"], owner_user_id, owner_account_id, owner_name) for u in users]
+    owners = sorted({w[0] for w in wanted})
+    existing = {
+        (r["owner_user_id"], r["target_user_id"], r["target_account_id"])
+        for r in db.execute(
+            f"""
+            SELECT owner_user_id, target_user_id, target_account_id FROM contacts
+            WHERE owner_user_id IN ({", ".join("?" * len(owners))})
+            """,
+            owners,
+        )
+    }
+    contacts_rows = []
+    for owner_id, target_user_id, target_account_id, display in wanted:
+        if (owner_id, target_user_id, target_account_id) in existing:
+            continue
+        contacts_rows.append((_next_id("CON", "contacts", "contact_id", db=db), owner_id, display,
+                              target_user_id, target_account_id))
+    db.executemany("""
+        INSERT INTO contacts (contact_id, owner_user_id, display_name, target_user_id, target_account_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, contacts_rows)
 
-    db.commit()
     return [u["user_id"] for u in users]
 
 
@@ -405,28 +921,61 @@ def seed_demo_more_users():
       - USE004 Giuseppe Verdi (ACC004)
       - USE005 Chiara Neri (ACC005)
     """
-    owner_user_id, owner_account_id, _piggy_id = _ensure_demo_entities()
-    _seed_additional_demo_users(owner_user_id=owner_user_id, owner_account_id=owner_account_id)
+    with _bulk_write():
+        owner_user_id, owner_account_id, _piggy_id = _ensure_demo_entities()
+        _seed_additional_demo_users(owner_user_id=owner_user_id, owner_account_id=owner_account_id)
     print("✅ seed-demo-more-users: creati/aggiornati USE002..USE005, conti e rubrica aggiornata.")
 
 
 # --- CLI Commands Database & Demo Seeds ---
+def _schema_template(schema_sql: str) -> Path:
+    """DB vuoto con schema e statistiche già applicati, uno per versione di schema.sql.
+
+    Il nome contiene l'hash dello schema: init-db ripetuti copiano il file invece di rieseguire
+    tutto il DDL, e una modifica allo schema produce da sé un template nuovo.
+    """
+    digest = hashlib.sha1(schema_sql.encode("utf-8")).hexdigest()[:12]
+    template = Path(app.instance_path) / f"schema_{digest}.db"
+    if template.exists():
+        return template
+    for old in Path(app.instance_path).glob("schema_*.db"):
+        old.unlink()
+    building = template.with_suffix(".tmp")
+    building.unlink(missing_ok=True)
+    conn = _open_connection(str(building))
+    try:
+        conn.executescript(schema_sql + "\nANALYZE;\n")
+        conn.commit()
+    finally:
+        conn.close()  # ultima connessione: il WAL viene riversato nel file e rimosso
+    os.replace(building, template)
+    return template
+
 @app.cli.command("init-db")
 def init_db_cmd():
     schema_path = Path("schema.sql")
     if not schema_path.exists():
         raise SystemExit("schema.sql non trovato nella root del progetto.")
-    db_file = Path(app.config['DATABASE'])
-    if db_file.exists():
-        db_file.unlink()
-    exec_script(schema_path.read_text(encoding="utf-8"))
+    schema_sql = schema_path.read_text(encoding="utf-8")
+    if app.config['DATABASE'] == ":memory:":
+        exec_script(schema_sql + "\nANALYZE;\n")
+    else:
+        db_file = Path(app.config['DATABASE'])
+        # in WAL rimuove anche i file -wal/-shm, altrimenti verrebbero riapplicati al nuovo db
+        for path in (db_file, db_file.with_name(db_file.name + "-wal"), db_file.with_name(db_file.name + "-shm")):
+            if path.exists():
+                path.unlink()
+        shutil.copyfile(_schema_template(schema_sql), db_file)
+    _invalidate_user_lookup()
+    _invalidate_contacts_cache()
     print("✅ Database inizializzato.")
 
 @app.cli.command("seed-demo")
 def seed_demo_cmd():
-    user_id, account_id, piggy_id = _ensure_demo_entities()
-    extra_users = _seed_additional_demo_users(owner_user_id=user_id, owner_account_id=account_id)
-    stats = _seed_transactions_last_12_months(account_id=account_id, piggy_id=piggy_id)
+    with _bulk_write():
+        user_id, account_id, piggy_id = _ensure_demo_entities()
+        extra_users = _seed_additional_demo_users(owner_user_id=user_id, owner_account_id=account_id)
+        stats = _seed_transactions_last_12_months(account_id=account_id, piggy_id=piggy_id)
 
     test_users = [user_id]
     if "USE002" in extra_users:
@@ -438,130 +987,125 @@ def seed_demo_cmd():
 
 @app.cli.command("seed-demo-data")
 def seed_demo_data_cmd():
-    db = get_db()
-    user_id = "USE001"
-    u = db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
-    if not u:
-        raise SystemExit("Prima esegui: flask --app app seed-demo")
+    with _bulk_write() as db:
+        user_id = "USE001"
+        u = db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if not u:
+            raise SystemExit("Prima esegui: flask --app app seed-demo")
 
-    db.execute("""
-        INSERT INTO accounts (account_id, user_id, iban, name, currency, balance)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(account_id) DO NOTHING
-    """, ("ACC001", user_id, "IT60X0542811101000000123456", "Conto Principale", "EUR", 1250.00))
-
-    db.execute("""
-        INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(piggy_id) DO NOTHING
-    """, ("PIG001", user_id, "Vacanze", 1000.00, 150.00, "ACTIVE"))
-
-    trx = [
-        ("TRX001", "ACC001", None, "2025-09-10", "Stipendio", "Entrate", "CREDIT", 1500.00),
-        ("TRX002", "ACC001", None, "2025-09-11", "Spesa Supermercato", "Spesa", "DEBIT", -85.20),
-        ("TRX003", "ACC001", None, "2025-09-12", "Abbonamento Netflix", "Abbonamenti", "DEBIT", -12.99),
-        ("TRX004", "ACC001", "PIG001", "2025-09-13", "Trasferimento Salvadanio", "Risparmio", "DEBIT", -100.00),
-        ("TRX005", "ACC001", None, "2025-09-14", "Cena fuori", "Ristoranti", "DEBIT", -52.40)
-    ]
-    for t in trx:
         db.execute("""
-            INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(transaction_id) DO NOTHING
-        """, t)
+            INSERT INTO accounts (account_id, user_id, iban, name, currency, balance)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(account_id) DO NOTHING
+        """, ("ACC001", user_id, "IT60X0542811101000000123456", "Conto Principale", "EUR", 1250.00))
 
-    transfers = [
-        ("TRP001", "PIG001", "ACC001", "2025-09-13", 100.00, "TO_PIGGY", "Accantonamento mensile"),
-        ("TRP002", "PIG001", "ACC001", "2025-09-15", 50.00, "FROM_PIGGY", "Imprevisto")
-    ]
-    for tr in transfers:
         db.execute("""
-            INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(transfer_id) DO NOTHING
-        """, tr)
-
-    db.execute("UPDATE accounts SET balance = ? WHERE account_id = 'ACC001'", (1250.00,))
-    db.execute("UPDATE piggy_banks SET current_amount = ? WHERE piggy_id = 'PIG001'", (_get_piggy_balance("PIG001"),))
-    db.commit()
+            INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(piggy_id) DO NOTHING
+        """, ("PIG001", user_id, "Vacanze", 1000.00, 150.00, "ACTIVE"))
+
+        trx = [
+            ("TRX001", "ACC001", None, "2025-09-10", "Stipendio", "Entrate", "CREDIT", 1500.00),
+            ("TRX002", "ACC001", None, "2025-09-11", "Spesa Supermercato", "Spesa", "DEBIT", -85.20),
+            ("TRX003", "ACC001", None, "2025-09-12", "Abbonamento Netflix", "Abbonamenti", "DEBIT", -12.99),
+            ("TRX004", "ACC001", "PIG001", "2025-09-13", "Trasferimento Salvadanio", "Risparmio", "DEBIT", -100.00),
+            ("TRX005", "ACC001", None, "2025-09-14", "Cena fuori", "Ristoranti", "DEBIT", -52.40)
+        ]
+        db.executemany(_SQL_INSERT_TX_IF_NEW, trx)
+
+        transfers = [
+            ("TRP001", "PIG001", "ACC001", "2025-09-13", 100.00, "TO_PIGGY", "Accantonamento mensile"),
+            ("TRP002", "PIG001", "ACC001", "2025-09-15", 50.00, "FROM_PIGGY", "Imprevisto")
+        ]
+        db.executemany(_SQL_INSERT_PIGGY_TRANSFER_IF_NEW, transfers)
+
+        _sync_id_counter("TRX", trx[-1][0], db=db)
+        _sync_id_counter("TRP", transfers[-1][0], db=db)
+
+        db.execute("UPDATE accounts SET balance = ? WHERE account_id = 'ACC001'", (1250.00,))
+        _recalc_piggy("PIG001", db=db)
     print("✅ Dati demo inseriti.")
 
 
 # --- Piggy Bank Helpers ---
 
 
-def _get_piggy_balance(piggy_id: str) -> float:
-    """Ritorna il saldo reale del salvadanaio calcolato dalle movimentazioni."""
-    db = get_db()
+def _get_piggy_balance(piggy_id: str, *, db: sqlite3.Connection | None = None) -> float:
+    """Ritorna il saldo del salvadanaio (current_amount, mantenuto dal trigger su piggy_transfers)."""
+    db = db or get_db()
+    row = db.execute("SELECT current_amount FROM piggy_banks WHERE piggy_id = ?", (piggy_id,)).fetchone()
+    return float(row["current_amount"] or 0.0) if row else 0.0
+
+def _sum_piggy_transfers(piggy_id: str, *, db: sqlite3.Connection | None = None) -> float:
+    """Saldo del salvadanaio ricalcolato da tutte le movimentazioni (riallineamento e audit)."""
+    db = db or get_db()
+    # due range sull'indice (piggy_id, direction, amount): niente lettura della tabella né CASE per riga
     row = db.execute("""
         SELECT
-          COALESCE(SUM(CASE WHEN direction='TO_PIGGY' THEN amount ELSE 0 END),0) -
-          COALESCE(SUM(CASE WHEN direction='FROM_PIGGY' THEN amount ELSE 0 END),0) AS tot
-        FROM piggy_transfers
-        WHERE piggy_id = ?
+          (SELECT COALESCE(SUM(amount),0) FROM piggy_transfers WHERE piggy_id = ?1 AND direction = 'TO_PIGGY') -
+          (SELECT COALESCE(SUM(amount),0) FROM piggy_transfers WHERE piggy_id = ?1 AND direction = 'FROM_PIGGY') AS tot
     """, (piggy_id,)).fetchone()
     return float(row["tot"] or 0.0)
 
-def _recalc_piggy(piggy_id: str):
-    """Aggiorna current_amount al valore calcolato da piggy_transfers."""
-    db = get_db()
-    piggy_sum = _get_piggy_balance(piggy_id)
+def _recalc_piggy(piggy_id: str, *, db: sqlite3.Connection | None = None):
+    """Riallinea current_amount al valore calcolato da piggy_transfers.
+
+    Nei flussi ordinari current_amount è mantenuto dal trigger su piggy_transfers:
+    serve solo dopo modifiche massive (es. pulizia dei dati demo). Lavora nella
+    transazione corrente: il commit spetta al chiamante.
+    """
+    db = db or get_db()
+    piggy_sum = _sum_piggy_transfers(piggy_id, db=db)
     db.execute("UPDATE piggy_banks SET current_amount = ? WHERE piggy_id = ?", (piggy_sum, piggy_id))
-    db.commit()
 
-def _apply_account_delta(account_id: str, delta: float):
-    db = get_db()
-    db.execute(
-        "UPDATE accounts SET balance = COALESCE(balance, 0) + ? WHERE account_id = ?",
-        (float(delta), account_id)
-    )
+def _create_piggy(user_id: str, name: str, target_amount: float | None, *,
+                  db: sqlite3.Connection | None = None) -> str:
+    """Crea un salvadanaio vuoto: ID dal contatore e INSERT nella stessa transazione di scrittura."""
+    with _write_tx(db) as db:
+        piggy_id = _next_id("PIG", "piggy_banks", "piggy_id", db=db)
+        db.execute(_SQL_INSERT_PIGGY, (piggy_id, user_id, name, target_amount))
+    return piggy_id
 
-def _ensure_user_owns_piggy(user_id: str, piggy_id: str) -> bool:
-    db = get_db()
-    row = db.execute("SELECT 1 FROM piggy_banks WHERE piggy_id = ? AND user_id = ? AND status != 'DELETED'",
-                     (piggy_id, user_id)).fetchone()
-    return bool(row)
+def _insert_piggy_transfer(*, user_id: str, piggy_id: str, account_id: str, amount: float,
+                           direction: str, note: str | None, tx_on_account: bool, when: str | None = None,
+                           db: sqlite3.Connection | None = None):
+    """Inserisce un trasferimento salvadanaio con guard-rail che impedisce saldo negativo.
 
-def _insert_piggy_transfer(*, piggy_id: str, account_id: str, amount: float,
-                           direction: str, note: str | None, tx_on_account: bool, when: str | None = None):
-    """Inserisce un trasferimento salvadanaio con guard-rail che impedisce saldo negativo."""
+    Lo stesso INSERT verifica che il salvadanaio sia attivo e dell'utente: niente SELECT preliminare.
+    """
     assert direction in ("TO_PIGGY", "FROM_PIGGY")
-    db = get_db()
-    transfer_id = _next_id("TRP", "piggy_transfers", "transfer_id")
-    when = when or date.today().isoformat()
-
-    # --- GUARD RAIL: no saldo negativo del salvadanaio ---
-    current = _get_piggy_balance(piggy_id)
-    projected = current + (amount if direction == "TO_PIGGY" else -amount)
-    if projected < 0:
-        raise ValueError("Saldo salvadanaio insufficiente per questa operazione.")
-
-    db.execute("""
-        INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (transfer_id, piggy_id, account_id, when, float(amount), direction, note))
-    _recalc_piggy(piggy_id)
-
-    if tx_on_account:
-        tx_id = _next_id("TRX", "transactions", "transaction_id")
-        if direction == "TO_PIGGY":
-            tx_amount = -abs(float(amount))  # uscita dal conto
-            tx_type = "DEBIT"
-            desc = "Trasferimento verso salvadanaio"
-        else:
-            tx_amount = abs(float(amount))   # entrata sul conto
-            tx_type = "CREDIT"
-            desc = "Prelievo da salvadanaio"
-
-        cur = db.execute("""
-            INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (tx_id, account_id, piggy_id, when, desc, "Risparmio", tx_type, tx_amount))
+    db = db or get_db()
+    when = when or _today_iso()
+
+    amount_cents = abs(_to_cents(amount))
+    signed_cents = amount_cents if direction == "TO_PIGGY" else -amount_cents
+
+    with _write_tx(db):
+        # --- GUARD RAIL: proprietà e no saldo negativo del salvadanaio (nello stesso INSERT) ---
+        transfer_id = _next_id("TRP", "piggy_transfers", "transfer_id", db=db)
+        inserted = db.execute(_SQL_INSERT_PIGGY_TRANSFER_GUARDED,
+                              (transfer_id, account_id, when, amount_cents / 100, direction, note,
+                               piggy_id, user_id, signed_cents))
+        if inserted.rowcount == 0:
+            exists = db.execute(_SQL_OWNED_PIGGY_BALANCE, (piggy_id, user_id)).fetchone()
+            raise ValueError("Saldo salvadanaio insufficiente per questa operazione." if exists
+                             else "Salvadanaio non trovato.")
+
+        if tx_on_account:
+            tx_id = _next_id("TRX", "transactions", "transaction_id", db=db)
+            if direction == "TO_PIGGY":
+                tx_amount = -amount_cents / 100  # uscita dal conto
+                tx_type = "DEBIT"
+                desc = "Trasferimento verso salvadanaio"
+            else:
+                tx_amount = amount_cents / 100   # entrata sul conto
+                tx_type = "CREDIT"
+                desc = "Prelievo da salvadanaio"
+
+            # il saldo del conto è aggiornato dal trigger su transactions
+            db.execute(_SQL_INSERT_TX, (tx_id, account_id, piggy_id, when, desc, "Risparmio", tx_type, tx_amount))
 
-        if cur.rowcount:
-            _apply_account_delta(account_id, tx_amount)
-
-    db.commit()
     return transfer_id
 
 # --- P2P & Split Helpers ---
@@ -632,12 +1176,14 @@ def _get_split_group(user_id: str, group_id: str):
     ).fetchone()
 
 
-def _get_split_members(user_id: str, group_id: str) -> list[sqlite3.Row]:
-    db = get_db()
-    return db.execute(
+def _get_split_members(user_id: str, group_id: str) -> list[tuple]:
+    """Membri del gruppo come tuple (member_id, contact_id, target_user_id, target_account_id,
+    display_name): lo split le spacchetta una volta per iterazione invece di cercare per nome."""
+    cur = get_db().cursor()
+    cur.row_factory = None
+    return cur.execute(
         """
-        SELECT m.member_id, m.group_id, m.contact_id, m.display_name,
-               c.target_user_id, c.target_account_id
+        SELECT m.member_id, m.contact_id, c.target_user_id, c.target_account_id, m.display_name
         FROM split_group_members m
         JOIN contacts c ON c.contact_id = m.contact_id
         WHERE m.group_id = ? AND c.owner_user_id = ?
@@ -647,35 +1193,31 @@ def _get_split_members(user_id: str, group_id: str) -> list[sqlite3.Row]:
     ).fetchall()
 
 
-def _split_even(amount: Decimal, count: int) -> list[Decimal]:
-    """Dividi amount in count quote (centesimi) restituendo una lista di Decimal."""
+def _split_even_cents(cents_total: int, count: int) -> list[int]:
+    """Dividi cents_total in count quote intere; il resto va un centesimo a testa alle prime.
+
+    L'importo arriva già in centesimi (_to_cents al parsing): il chiamante formatta con ``/ 100``.
+    """
     if count <= 0:
         return []
-    cents_total = int((amount * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
-    base = cents_total // count
-    remainder = cents_total - base * count
-    shares = [base] * count
-    for idx in range(remainder):
-        shares[idx] += 1
-    return [Decimal(s) / Decimal(100) for s in shares]
+    base, remainder = divmod(cents_total, count)
+    return [base + 1] * remainder + [base] * (count - remainder)
 
 def _p2p_instant(*, from_account_id: str, to_account_id: str, amount: float,
                  message: str | None, from_user_id: str, to_user_id: str,
-                 to_name: str | None = None, from_name: str | None = None):
-    """Trasferimento interno istantaneo: crea 2 transazioni e aggiorna saldi."""
-    if amount <= 0:
-        raise ValueError("Importo non valido")
-    db = get_db()
-
-    # verifica saldo sufficiente
-    bal = db.execute("SELECT balance FROM accounts WHERE account_id = ?", (from_account_id,)).fetchone()
-    if not bal:
-        raise ValueError("Conto mittente non trovato")
-    if float(bal["balance"] or 0) < amount - 1e-9:
-        raise ValueError("Saldo insufficiente")
+                 to_name: str | None = None, from_name: str | None = None,
+                 db: sqlite3.Connection | None = None, commit: bool = True):
+    """Trasferimento interno istantaneo: crea 2 transazioni e aggiorna saldi.
 
-    p2p_id = _next_id("P2P", "p2p_transfers", "p2p_id")
-    today  = date.today().isoformat()
+    Con commit=False la transazione (BEGIN/commit/rollback) la gestisce il chiamante,
+    così più invii finiscono in un solo commit.
+    """
+    amount_cents = _to_cents(amount)
+    if amount_cents <= 0:
+        raise ValueError("Importo non valido")
+    db = db or get_db()
+    amount = amount_cents / 100
+    today  = _today_iso()
 
     desc_out = f"P2P a {to_name or ('utente ' + to_user_id)}"
     desc_in  = f"P2P da {from_name or ('utente ' + from_user_id)}"
@@ -684,89 +1226,214 @@ def _p2p_instant(*, from_account_id: str, to_account_id: str, amount: float,
         desc_in  += f" — {message}"
 
     try:
-        # Avvia transazione esplicita
-        db.execute("BEGIN")
+        # Avvia transazione esplicita (anche il contatore ID ne fa parte)
+        if commit:
+            db.execute("BEGIN IMMEDIATE")
 
-        # 1) Mittente: DEBIT (subito dopo genero e INSERISCO)
-        tx_out = _next_id("TRX", "transactions", "transaction_id")
-        db.execute("""
-            INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-            VALUES (?, ?, NULL, ?, ?, 'P2P', 'DEBIT', ?)
-        """, (tx_out, from_account_id, today, desc_out, -abs(float(amount))))
-        _apply_account_delta(from_account_id, -abs(float(amount)))
+        p2p_id = _next_id("P2P", "p2p_transfers", "p2p_id", db=db)
+        tx_out = _next_id("TRX", "transactions", "transaction_id", db=db)
+        tx_in = _next_id("TRX", "transactions", "transaction_id", db=db)
 
-        # 2) Destinatario: CREDIT (genera ID SOLO ORA, dopo il primo insert)
-        tx_in = _next_id("TRX", "transactions", "transaction_id")
-        db.execute("""
+        # 1) Mittente: DEBIT inserito solo se il saldo è sufficiente (i saldi li aggiorna il trigger)
+        debit = db.execute("""
             INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-            VALUES (?, ?, NULL, ?, ?, 'P2P', 'CREDIT', ?)
-        """, (tx_in, to_account_id, today, desc_in, abs(float(amount))))
-        _apply_account_delta(to_account_id, abs(float(amount)))
+            SELECT ?, account_id, NULL, ?, ?, 'P2P', 'DEBIT', ?
+            FROM accounts
+            WHERE account_id = ? AND CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER) >= ?
+        """, (tx_out, today, desc_out, -amount, from_account_id, amount_cents))
+        if debit.rowcount == 0:
+            exists = db.execute("SELECT 1 FROM accounts WHERE account_id = ?", (from_account_id,)).fetchone()
+            raise ValueError("Saldo insufficiente" if exists else "Conto mittente non trovato")
+
+        # 2) Destinatario: CREDIT
+        db.execute(_SQL_INSERT_TX, (tx_in, to_account_id, None, today, desc_in, "P2P", "CREDIT", amount))
 
         # 3) Record P2P
-        db.execute("""
-            INSERT INTO p2p_transfers (p2p_id, from_user_id, to_user_id, from_account_id, to_account_id, amount, message)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (p2p_id, from_user_id, to_user_id, from_account_id, to_account_id, float(amount), message))
+        db.execute(_SQL_INSERT_P2P,
+                   (p2p_id, from_user_id, to_user_id, from_account_id, to_account_id, amount, message))
 
-        db.commit()
+        if commit:
+            db.commit()
         return p2p_id
 
     except Exception:
-        db.rollback()
+        if commit:
+            db.rollback()
         raise
 
 
 
+def _p2p_instant_bulk(*, from_account_id: str, from_user_id: str, from_name: str | None,
+                      message: str | None, sends: list[tuple[str, str, str | None, int]],
+                      db: sqlite3.Connection | None = None, commit: bool = True) -> list[str]:
+    """Come _p2p_instant ma verso più destinatari in blocco.
+
+    sends contiene tuple (to_account_id, to_user_id, to_name, amount_cents); ritorna i p2p_id
+    nello stesso ordine. Saldo verificato una volta sul totale, ID riservati a blocchi e righe
+    scritte con executemany (i saldi li aggiornano comunque i trigger).
+    """
+    if not sends or any(cents <= 0 for *_, cents in sends):
+        raise ValueError("Importo non valido")
+    db = db or get_db()
+    today = _today_iso()
+    suffix = f" — {message}" if message else ""
+    desc_in = f"P2P da {from_name or ('utente ' + from_user_id)}{suffix}"
+
+    try:
+        if commit:
+            db.execute("BEGIN IMMEDIATE")
+
+        account = db.execute(
+            "SELECT CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER) FROM accounts WHERE account_id = ?",
+            (from_account_id,),
+        ).fetchone()
+        if not account:
+            raise ValueError("Conto mittente non trovato")
+        if account[0] < sum(cents for *_, cents in sends):
+            raise ValueError("Saldo insufficiente")
+
+        p2p_ids = _next_ids("P2P", "p2p_transfers", "p2p_id", len(sends), db=db)
+        tx_ids = _next_ids("TRX", "transactions", "transaction_id", 2 * len(sends), db=db)
+        tx_rows, p2p_rows = [], []
+        for i, (to_account_id, to_user_id, to_name, cents) in enumerate(sends):
+            amount = cents / 100
+            desc_out = f"P2P a {to_name or ('utente ' + to_user_id)}{suffix}"
+            tx_rows.append((tx_ids[2 * i], from_account_id, None, today, desc_out, "P2P", "DEBIT", -amount))
+            tx_rows.append((tx_ids[2 * i + 1], to_account_id, None, today, desc_in, "P2P", "CREDIT", amount))
+            p2p_rows.append((p2p_ids[i], from_user_id, to_user_id, from_account_id, to_account_id, amount, message))
+        db.executemany(_SQL_INSERT_TX, tx_rows)
+        db.executemany(_SQL_INSERT_P2P, p2p_rows)
+
+        if commit:
+            db.commit()
+        return p2p_ids
+
+    except Exception:
+        if commit:
+            db.rollback()
+        raise
+
 
 # --- Demo Data 12-Month Scenario ---
 
 def _month_iter(n_back: int = 12):
     """Ritorna gli ultimi n_back mesi come (year, month), dal mese corrente indietro."""
     today = date.today()
-    y, m = today.year, today.month
+    current = today.year * 12 + today.month - 1  # mesi dall'anno 0
+    return [(idx // 12, idx % 12 + 1) for idx in range(current - n_back + 1, current + 1)]
+
+# Stagionalità della spesa demo, indicizzata per month - 1 (luglio/agosto viaggi, dicembre regali)
+_SEASONAL_MULT = (1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.25, 1.25, 1.0, 1.0, 1.0, 1.20)
+
+def _month_info(n_back: int = 12) -> list[tuple[int, int, int, int]]:
+    """Come _month_iter ma con (year, month, ultimo giorno, weekday del giorno 1) già calcolati."""
     out = []
-    for _ in range(n_back):
-        out.append((y, m))
-        m -= 1
-        if m == 0:
-            y -= 1
-            m = 12
-    return list(reversed(out))
-
-def _rand_day(year: int, month: int, preferred: int | None = None):
-    """Giorno del mese realistico: se preferred è None, un giorno casuale non festivo."""
-    last_day = calendar.monthrange(year, month)[1]
-    if preferred and 1 <= preferred <= last_day:
-        return preferred
-    day = random.randint(2, min(last_day, 28))   # evita 29-31
-    dt = date(year, month, day)
-    if dt.weekday() == 6:                         # evita domenica
-        day = max(2, day - 1)
-    return day
-
-def _safe_day(y: int, m: int, d: int) -> int:
+    for y, m in _month_iter(n_back):
+        first_weekday, last_day = calendar.monthrange(y, m)
+        out.append((y, m, last_day, first_weekday))
+    return out
+
+def _day_pool(first_weekday: int, last_day: int) -> tuple[int, ...]:
+    """Giorni del mese realistici (2..28, la domenica slitta al sabato), da usare con rng.choices."""
+    # weekday del giorno d = (first_weekday + d - 1) % 7; domenica = 6
+    return tuple(max(2, d - 1) if (first_weekday + d - 1) % 7 == 6 else d
+                 for d in range(2, min(last_day, 28) + 1))   # evita 29-31
+
+def _uniforms(rng: random.Random, low: float, high: float, k: int) -> list[float]:
+    """k estrazioni uniformi in [low, high), come random.uniform ma in un'unica comprehension."""
+    rnd = rng.random
+    span = high - low
+    return [low + span * rnd() for _ in range(k)]
+
+def _iso(y: int, m: int, d: int) -> str:
+    """Data "YYYY-MM-DD" senza passare da date(...).isoformat()."""
+    return f"{y:04d}-{m:02d}-{d:02d}"
+
+def _safe_day(y: int, m: int, d: int, last_day: int, today: date) -> int:
     """Rende il giorno valido nel mese e MAI futuro se è il mese corrente."""
-    last = calendar.monthrange(y, m)[1]
-    d = max(1, min(d, last))
-    today = date.today()
+    d = max(1, min(d, last_day))
     if y == today.year and m == today.month:
         d = min(d, today.day)
     return d
 
-def _add_tx(*, account_id: str, y: int, m: int, d: int, desc: str,
-            category: str, ttype: str, amount: float, piggy_id: str | None = None):
-    """Inserisce una transazione. DEBIT negativo, CREDIT positivo."""
-    assert ttype in ("DEBIT", "CREDIT")
-    db = get_db()
-    tx_id = _next_id("TRX", "transactions", "transaction_id")
-    d = _safe_day(y, m, d)  # <<< evita date future
-    iso_date = date(y, m, d).isoformat()
-    db.execute("""
-        INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (tx_id, account_id, piggy_id, iso_date, desc, category, ttype, float(amount)))
-    return float(amount)
+# Spese variabili demo:
+# (min/mese, max/mese, esercenti, descrizione, categoria, importo min, importo max, stagionale)
+_DEMO_VARIABLE_SPECS = (
+    (3, 6, ("Coop", "Conad", "Esselunga", "Carrefour", "Lidl"), "Spesa {}", "Spesa", 28, 110, True),
+    (2, 5, ("Trattoria da Mario", "Pizzeria Bella Napoli", "Sushi Go", "Osteria del Centro"),
+     "{}", "Ristoranti", 15, 55, True),
+    (0, 2, ("ENI", "Q8", "IP", "Tamoil"), "Carburante {}", "Trasporti", 45, 120, False),
+    (1, 3, ("Zara", "Decathlon", "MediaWorld", "Amazon", "IKEA"), "{}", "Shopping", 20, 150, True),
+)
+_DEMO_UTILITIES = ("Bolletta Luce", "Bolletta Gas", "Bolletta Acqua")
+_DEMO_SUB_DAYS = range(5, 13)
+
+def _gen_month(y: int, m: int, last_day: int, first_wd: int, today: date, seed: int,
+               params: dict) -> tuple[list[tuple], list[tuple], float]:
+    """Genera i movimenti demo di un mese. Funzione pura: stesso seed, stessi dati.
+
+    Ritorna (movimenti, operazioni salvadanaio, flusso netto del conto): i movimenti sono
+    (date, description, category, type, amount), le operazioni (date, amount, direction, note).
+    Il guard-rail del salvadanaio dipende dai mesi precedenti e resta al chiamante.
+    """
+    rng = random.Random(seed)
+    mult = _SEASONAL_MULT[m - 1]
+    rows: list[tuple] = []
+    piggy_ops: list[tuple] = []
+
+    # stringhe ISO del mese già calcolate per ogni giorno richiedibile (0..32, clamp incluso)
+    iso_days = [_iso(y, m, _safe_day(y, m, d, last_day, today)) for d in range(33)]
+    day_ok = iso_days.__getitem__
+    days = _day_pool(first_wd, last_day)
+
+    # Stipendio (27 del mese o l'ultimo giorno lavorativo precedente)
+    salary_amt = float(rng.randint(params["salary_min"], params["salary_max"]))
+    d = min(27, last_day)
+    if (first_wd + d - 1) % 7 == 6:  # se domenica, anticipa di 1
+        d -= 1
+    rows.append((day_ok(d), "Stipendio", "Entrate", "CREDIT", salary_amt))
+
+    # Affitto (1 del mese)
+    rows.append((day_ok(1), "Affitto", "Casa", "DEBIT", -float(params["rent"])))
+
+    # Abbonamenti (tra il 5 e il 12): importi fissi, mese per mese cambia solo il giorno
+    subs = params["subs"]
+    rows.extend((day_ok(day), name, cat, "DEBIT", debit)
+                for (name, cat, debit), day in zip(subs, rng.choices(_DEMO_SUB_DAYS, k=len(subs))))
+
+    # Utenze (metà mese)
+    bolletta = rng.choice(_DEMO_UTILITIES)
+    util_cost = round(rng.uniform(params["utilities_min"], params["utilities_max"]) * mult, 2)
+    rows.append((day_ok(rng.randint(13, 19)), bolletta, "Utenze", "DEBIT", -util_cost))
+
+    # Spese variabili: conteggio, esercenti, importi e giorni estratti in blocco per categoria
+    for n_min, n_max, labels, desc_fmt, category, low, high, seasonal in _DEMO_VARIABLE_SPECS:
+        n = rng.randint(n_min, n_max)
+        factor = mult if seasonal else 1.0
+        for label, raw, day in zip(rng.choices(labels, k=n), _uniforms(rng, low, high, n),
+                                   rng.choices(days, k=n)):
+            rows.append((day_ok(day), desc_fmt.format(label), category, "DEBIT", -round(raw * factor, 2)))
+
+    # Sanità (0–1/mese)
+    if rng.random() < 0.35:
+        day = rng.choices(days)[0]
+        rows.append((day_ok(day), "Ticket sanitario", "Sanità", "DEBIT", -round(rng.uniform(20, 80), 2)))
+
+    # Viaggi (estate o dicembre): hotel + treno/aereo
+    if m in (7, 8) or (m == 12 and rng.random() < 0.4):
+        day1 = _safe_day(y, m, rng.choices(days)[0], last_day, today)
+        day2 = max(day1, _safe_day(y, m, day1 + 2, last_day, today))
+        rows.append((day_ok(day1), "Hotel", "Viaggi", "DEBIT", -round(rng.uniform(120, 280), 2)))
+        rows.append((day_ok(day2), "Treno/Aereo", "Viaggi", "DEBIT", -round(rng.uniform(70, 180), 2)))
+
+    # Accantonamento nel salvadanaio (100€/mese) – clamp giorno (max oggi)
+    piggy_ops.append((day_ok(25), 100.0, "TO_PIGGY", "Accantonamento mensile"))
+
+    # Imprevisto estivo (agosto): FROM_PIGGY 100–200 – clamp giorno
+    if m == 8 and rng.random() < 0.5:
+        piggy_ops.append((day_ok(28), rng.choice([100.0, 150.0, 200.0]), "FROM_PIGGY", "Imprevisto estivo"))
+
+    return rows, piggy_ops, sum(r[4] for r in rows)
 
 def _ensure_demo_entities():
     """Assicura utente, account e salvadanaio demo."""
@@ -774,10 +1441,9 @@ def _ensure_demo_entities():
     # Utente
     u = db.execute("SELECT user_id FROM users WHERE user_id='USE001'").fetchone()
     if not u:
-        from werkzeug.security import generate_password_hash
         db.execute("""INSERT INTO users (user_id, codice_cliente, first_name, last_name, password_hash)
                       VALUES ('USE001','123456','Emanuele','Chiummo',?)""",
-                   (generate_password_hash("Password123!"),))
+                   (generate_password_hash("Password123!", method=_PASSWORD_HASH_METHOD),))
     # Account
     a = db.execute("SELECT account_id FROM accounts WHERE account_id='ACC001'").fetchone()
     if not a:
@@ -788,7 +1454,6 @@ def _ensure_demo_entities():
     if not p:
         db.execute("""INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
                       VALUES ('PIG001','USE001','Vacanze',1000,0,'ACTIVE')""")
-    db.commit()
     return "USE001", "ACC001", "PIG001"
 
 def _seed_transactions_last_12_months(*, account_id: str, piggy_id: str) -> dict[str, float]:
@@ -796,161 +1461,72 @@ def _seed_transactions_last_12_months(*, account_id: str, piggy_id: str) -> dict
     Genera dati demo realistici per gli ultimi 12 mesi sull'account indicato
     e restituisce informazioni riassuntive.
     """
-    random.seed(42)  # riproducibilità
+    rng = random.Random(42)  # riproducibilità, senza toccare lo stato globale di random
     db = get_db()
 
     # 1) Pulisci periodo target (ultimi 13 mesi per sicurezza)
     cutoff = (date.today().replace(day=1) - timedelta(days=370)).isoformat()
     db.execute("DELETE FROM transactions WHERE account_id=? AND date >= ?", (account_id, cutoff))
-    db.execute("DELETE FROM piggy_transfers WHERE account_id=? AND date >= ?", (account_id, cutoff))
-    db.commit()
+    # il trigger AFTER DELETE aggiorna current_amount riga per riga e trg_piggy_banks_non_negative
+    # ne controlla ogni valore intermedio: prima i prelievi (il saldo sale), poi gli accantonamenti,
+    # così il saldo scende solo verso quello dei trasferimenti rimasti, che non è mai negativo
+    _recalc_piggy(piggy_id, db=db)
+    db.execute(_SQL_DELETE_PIGGY_TRANSFERS_SINCE, (account_id, cutoff, "FROM_PIGGY"))
+    db.execute(_SQL_DELETE_PIGGY_TRANSFERS_SINCE, (account_id, cutoff, "TO_PIGGY"))
+    _recalc_piggy(piggy_id, db=db)  # il guard-rail sotto legge current_amount
 
     # 2) Parametri realistici
-    base_opening = random.randint(600, 1400)  # saldo iniziale ipotetico
-    salary_min, salary_max = 1600, 2400
-    rent = random.choice([550, 650, 700, 800, 900])
-    utilities_min, utilities_max = 40, 120
-
-    subs = [
-        ("Netflix", "Abbonamenti", 12.99),
-        ("Spotify", "Abbonamenti", 9.99),
-        ("iCloud", "Abbonamenti", random.choice([0.99, 2.99])),
-    ]
+    base_opening = rng.randint(600, 1400)  # saldo iniziale ipotetico
+    params = {
+        "salary_min": 1600, "salary_max": 2400,
+        "rent": rng.choice([550, 650, 700, 800, 900]),
+        "utilities_min": 40, "utilities_max": 120,
+        # (nome, categoria, addebito mensile già con segno): il piano iCloud si sceglie una volta
+        "subs": (
+            ("Netflix", "Abbonamenti", -12.99),
+            ("Spotify", "Abbonamenti", -9.99),
+            ("iCloud", "Abbonamenti", -rng.choice([0.99, 2.99])),
+        ),
+    }
 
-    supermarkets = ["Coop", "Conad", "Esselunga", "Carrefour", "Lidl"]
-    diners = ["Trattoria da Mario", "Pizzeria Bella Napoli", "Sushi Go", "Osteria del Centro"]
-    fuel_stations = ["ENI", "Q8", "IP", "Tamoil"]
-    shops = ["Zara", "Decathlon", "MediaWorld", "Amazon", "IKEA"]
-    utilities_list = ["Bolletta Luce", "Bolletta Gas", "Bolletta Acqua"]
-
-    # Stagionalità (agosto/viaggi + dicembre/regali)
-    def seasonal_multiplier(month: int) -> float:
-        if month in (7, 8):   # luglio, agosto
-            return 1.25
-        if month == 12:       # dicembre
-            return 1.20
-        return 1.0
-
-    # 3) Generazione
+    # 3) Generazione: ogni mese è indipendente (seed derivato dal seed principale);
+    #    movimenti e trasferimenti salvadanaio si accumulano in memoria e vengono
+    #    inseriti alla fine con un executemany per tabella
+    today = date.today()
+    months = _month_info(12)
+    month_seeds = [rng.getrandbits(32) for _ in months]
+    generated = [_gen_month(y, m, last_day, first_wd, today, seed, params)
+                 for (y, m, last_day, first_wd), seed in zip(months, month_seeds)]
+
+    rows: list[tuple] = []
+    piggy_rows: list[tuple] = []
+    piggy_cents = _to_cents(_get_piggy_balance(piggy_id, db=db))
     net_flow = 0.0
-    for (y, m) in _month_iter(12):
-        mult = seasonal_multiplier(m)
-
-        # Stipendio (27 del mese o l'ultimo giorno lavorativo precedente)
-        salary_amt = random.randint(salary_min, salary_max)
-        d = min(27, calendar.monthrange(y, m)[1])
-        dt = date(y, m, d)
-        if dt.weekday() == 6:  # se domenica, anticipa di 1
-            d -= 1
-        net_flow += _add_tx(account_id=account_id, y=y, m=m, d=d,
-                            desc="Stipendio", category="Entrate",
-                            ttype="CREDIT", amount=salary_amt)
-
-        # Affitto (1 del mese)
-        net_flow += _add_tx(account_id=account_id, y=y, m=m, d=1,
-                            desc="Affitto", category="Casa",
-                            ttype="DEBIT", amount=-float(rent))
-
-        # Abbonamenti (tra il 5 e il 12)
-        for name, cat, fee in subs:
-            day = min(random.randint(5, 12), calendar.monthrange(y, m)[1])
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc=f"{name}", category=cat,
-                                ttype="DEBIT", amount=-round(fee, 2))
-
-        # Utenze (metà mese)
-        bolletta = random.choice(utilities_list)
-        util_cost = round(random.uniform(utilities_min, utilities_max) * mult, 2)
-        day_util = min(random.randint(13, 19), calendar.monthrange(y, m)[1])
-        net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day_util,
-                            desc=bolletta, category="Utenze",
-                            ttype="DEBIT", amount=-util_cost)
-
-        # Spesa (3–6 volte/mese)
-        for _ in range(random.randint(3, 6)):
-            market = random.choice(supermarkets)
-            cost = round(random.uniform(28, 110) * mult, 2)
-            day = _rand_day(y, m)
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc=f"Spesa {market}", category="Spesa",
-                                ttype="DEBIT", amount=-cost)
-
-        # Ristoranti (2–5/mese)
-        for _ in range(random.randint(2, 5)):
-            place = random.choice(diners)
-            cost = round(random.uniform(15, 55) * mult, 2)
-            day = _rand_day(y, m)
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc=place, category="Ristoranti",
-                                ttype="DEBIT", amount=-cost)
-
-        # Carburante/Trasporti (0–2/mese)
-        for _ in range(random.randint(0, 2)):
-            station = random.choice(fuel_stations)
-            cost = round(random.uniform(45, 120), 2)
-            day = _rand_day(y, m)
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc=f"Carburante {station}", category="Trasporti",
-                                ttype="DEBIT", amount=-cost)
-
-        # Shopping (1–3/mese)
-        for _ in range(random.randint(1, 3)):
-            shop = random.choice(shops)
-            cost = round(random.uniform(20, 150) * mult, 2)
-            day = _rand_day(y, m)
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc=shop, category="Shopping",
-                                ttype="DEBIT", amount=-cost)
-
-        # Sanità (0–1/mese)
-        if random.random() < 0.35:
-            day = _rand_day(y, m)
-            cost = round(random.uniform(20, 80), 2)
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day,
-                                desc="Ticket sanitario", category="Sanità",
-                                ttype="DEBIT", amount=-cost)
-
-        # Viaggi (estate o dicembre): hotel + treno/aereo
-        if m in (7, 8) or (m == 12 and random.random() < 0.4):
-            day1 = _safe_day(y, m, _rand_day(y, m))
-            day2 = _safe_day(y, m, min(day1 + 2, calendar.monthrange(y, m)[1]))
-            if day2 < day1:
-                day2 = day1
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day1,
-                                desc="Hotel", category="Viaggi",
-                                ttype="DEBIT", amount=-round(random.uniform(120, 280), 2))
-            net_flow += _add_tx(account_id=account_id, y=y, m=m, d=day2,
-                                desc="Treno/Aereo", category="Viaggi",
-                                ttype="DEBIT", amount=-round(random.uniform(70, 180), 2))
-
-        # Accantonamento nel salvadanaio (100€/mese) – clamp giorno (max oggi)
-        d_pig = _safe_day(y, m, min(25, calendar.monthrange(y, m)[1]))
-        try:
-            _insert_piggy_transfer(
-                piggy_id=piggy_id, account_id=account_id, amount=100.0,
-                direction="TO_PIGGY", note="Accantonamento mensile",
-                tx_on_account=True, when=date(y, m, d_pig).isoformat()
-            )
-        except Exception:
-            pass
-
-        # Imprevisto estivo (agosto): FROM_PIGGY 100–200 – clamp giorno
-        if m == 8 and random.random() < 0.5:
-            d_imp = _safe_day(y, m, min(28, calendar.monthrange(y, m)[1]))
-            try:
-                _insert_piggy_transfer(
-                    piggy_id=piggy_id, account_id=account_id,
-                    amount=random.choice([100.0, 150.0, 200.0]),
-                    direction="FROM_PIGGY", note="Imprevisto estivo",
-                    tx_on_account=True, when=date(y, m, d_imp).isoformat()
-                )
-            except Exception:
-                pass
+    for month_rows, piggy_ops, month_flow in generated:
+        rows.extend((account_id, None, *row) for row in month_rows)
+        net_flow += month_flow
+        # guard-rail del salvadanaio sul saldo progressivo (stesse regole di _insert_piggy_transfer)
+        for when, amount, direction, note in piggy_ops:
+            cents = _to_cents(amount)
+            delta = cents if direction == "TO_PIGGY" else -cents
+            if piggy_cents + delta < 0:
+                continue
+            piggy_cents += delta
+            piggy_rows.append((piggy_id, account_id, when, cents / 100, direction, note))
+            if direction == "TO_PIGGY":
+                rows.append((account_id, piggy_id, when, "Trasferimento verso salvadanaio", "Risparmio", "DEBIT", -cents / 100))
+            else:
+                rows.append((account_id, piggy_id, when, "Prelievo da salvadanaio", "Risparmio", "CREDIT", cents / 100))
+
+    # i saldi di conto e salvadanaio li aggiornano i trigger (e vengono riallineati sotto)
+    trp_ids = _next_ids("TRP", "piggy_transfers", "transfer_id", len(piggy_rows), db=db)
+    db.executemany(_SQL_INSERT_PIGGY_TRANSFER, [(trp_id, *row) for trp_id, row in zip(trp_ids, piggy_rows)])
+    tx_ids = _next_ids("TRX", "transactions", "transaction_id", len(rows), db=db)
+    db.executemany(_SQL_INSERT_TX, [(tx_id, *row) for tx_id, row in zip(tx_ids, rows)])
 
     # 4) Aggiorna saldo del conto e del salvadanaio
     db.execute("UPDATE accounts SET balance = ? WHERE account_id = ?", (float(base_opening + net_flow), account_id))
-    _recalc_piggy(piggy_id)
-    db.commit()
+    _recalc_piggy(piggy_id, db=db)
 
     return {
         "base_opening": float(base_opening),
@@ -961,40 +1537,162 @@ def _seed_transactions_last_12_months(*, account_id: str, piggy_id: str) -> dict
 @app.cli.command("seed-demo-12m")
 def seed_demo_12m():
     """Genera o rigenera un anno di movimenti demo per l'account principale."""
-    _user_id, account_id, piggy_id = _ensure_demo_entities()
-    stats = _seed_transactions_last_12_months(account_id=account_id, piggy_id=piggy_id)
+    with _bulk_write():
+        _user_id, account_id, piggy_id = _ensure_demo_entities()
+        stats = _seed_transactions_last_12_months(account_id=account_id, piggy_id=piggy_id)
     print(f"✅ Dati demo ultimi 12 mesi generati su {account_id}. Saldo base ~€{stats['base_opening']:.0f}, piggy ricalcolato.")
 
+@app.cli.command("audit-piggy")
+@click.option("--fix", is_flag=True, help="Riallinea current_amount alla somma delle movimentazioni.")
+def audit_piggy_cmd(fix: bool):
+    """Confronta current_amount di ogni salvadanaio con la somma di piggy_transfers."""
+    db = get_db()
+    rows = db.execute("""
+        SELECT p.piggy_id, COALESCE(p.current_amount, 0) AS current_amount,
+               COALESCE(SUM(CASE WHEN t.direction = 'TO_PIGGY' THEN t.amount ELSE -t.amount END), 0) AS expected
+        FROM piggy_banks p
+        LEFT JOIN piggy_transfers t ON t.piggy_id = p.piggy_id
+        GROUP BY p.piggy_id
+    """).fetchall()
+    mismatches = [r for r in rows if _to_cents(r["current_amount"]) != _to_cents(r["expected"])]
+    for r in mismatches:
+        print(f"⚠️  {r['piggy_id']}: current_amount={r['current_amount']:.2f} atteso={r['expected']:.2f}")
+        if fix:
+            _recalc_piggy(r["piggy_id"], db=db)
+    if fix and mismatches:
+        db.commit()
+    if not mismatches:
+        print(f"✅ audit-piggy: {len(rows)} salvadanai allineati.")
+    elif fix:
+        print(f"✅ audit-piggy: {len(mismatches)} salvadanai riallineati.")
+    else:
+        raise SystemExit(1)
+
 @app.cli.command("seed-demo-p2p")
 def seed_demo_p2p_cmd():
     """Crea un secondo utente + account e un contatto in rubrica per USE001."""
     db = get_db()
-    # utente 2
-    u2 = db.execute("SELECT 1 FROM users WHERE user_id='USE002'").fetchone()
-    if not u2:
-        db.execute("""INSERT INTO users (user_id, codice_cliente, first_name, last_name, password_hash)
-                      VALUES ('USE002', '654321', 'Mario', 'Rossi', ?)""",
-                   (generate_password_hash("Password123!"),))
-    a2 = db.execute("SELECT 1 FROM accounts WHERE account_id='ACC002'").fetchone()
-    if not a2:
-        db.execute("""INSERT INTO accounts (account_id, user_id, iban, name, currency, balance)
-                      VALUES ('ACC002','USE002','IT60X0542811101000000654321','Conto Mario','EUR',500.00)""")
+    # Ogni INSERT è idempotente (ON CONFLICT DO NOTHING); RETURNING dice se la riga è nuova
+    # e in quel caso il contatore ID del prefisso viene riallineato.
+    # utente 2: l'hash della password (PBKDF2/scrypt, decine di ms) si calcola solo se manca
+    if not db.execute("SELECT 1 FROM users WHERE user_id='USE002'").fetchone():
+        password_hash = generate_password_hash("Password123!", method=_PASSWORD_HASH_METHOD)
+        inserted = db.execute("""INSERT INTO users (user_id, codice_cliente, first_name, last_name, password_hash)
+                                 VALUES ('USE002', '654321', 'Mario', 'Rossi', ?)
+                                 ON CONFLICT DO NOTHING
+                                 RETURNING user_id""",
+                              (password_hash,)).fetchall()
+        if inserted:
+            _sync_id_counter("USE", "USE002", db=db)
+    inserted = db.execute("""INSERT INTO accounts (account_id, user_id, iban, name, currency, balance)
+                             VALUES ('ACC002','USE002','IT60X0542811101000000654321','Conto Mario','EUR',500.00)
+                             ON CONFLICT DO NOTHING
+                             RETURNING account_id""").fetchall()
+    if inserted:
+        _sync_id_counter("ACC", "ACC002", db=db)
     # contatto in rubrica per USE001 che punta a ACC002
-    c1 = db.execute("SELECT 1 FROM contacts WHERE contact_id='CON001' AND owner_user_id='USE001'").fetchone()
-    if not c1:
-        db.execute("""INSERT INTO contacts (contact_id, owner_user_id, display_name, target_user_id, target_account_id)
-                      VALUES ('CON001','USE001','Mario Rossi','USE002','ACC002')""")
+    inserted = db.execute("""INSERT INTO contacts (contact_id, owner_user_id, display_name, target_user_id, target_account_id)
+                             VALUES ('CON001','USE001','Mario Rossi','USE002','ACC002')
+                             ON CONFLICT DO NOTHING
+                             RETURNING contact_id""").fetchall()
+    if inserted:
+        _sync_id_counter("CON", "CON001", db=db)
     db.commit()
     print("✅ seed-demo-p2p: creati USE002/ACC002 e contatto CON001 per USE001.")
 
 
 
 # --- Authentication Utilities ---
+# Esito delle verifiche password recenti, per non rifare PBKDF2/scrypt sui re-submit ravvicinati.
+# La chiave è un HMAC (segreto di processo) di hash salvato + password: nessuna password in
+# chiaro in memoria, e un cambio password cambia l'hash e quindi invalida da sé le voci.
+_PASSWORD_CHECK_TTL = 10.0
+_PASSWORD_CHECK_MAXSIZE = 1024
+_password_check_key = os.urandom(32)
+_password_check_cache: dict[bytes, tuple[float, bool]] = {}
+_password_check_lock = threading.Lock()
+
+
+def _verify_password(password_hash: str, password: str) -> bool:
+    key = hmac.new(_password_check_key, f"{password_hash}\0{password}".encode("utf-8"), hashlib.sha256).digest()
+    now = time.monotonic()
+    with _password_check_lock:
+        cached = _password_check_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    ok = check_password_hash(password_hash, password)
+    with _password_check_lock:
+        if len(_password_check_cache) >= _PASSWORD_CHECK_MAXSIZE:
+            _password_check_cache.clear()
+        _password_check_cache[key] = (now + _PASSWORD_CHECK_TTL, ok)
+    return ok
+
+
+# Utenti cercati per codice_cliente al login: codice -> (scadenza monotonic, riga utente).
+# Solo i codici esistenti: un codice sconosciuto non occupa la cache e un utente appena creato
+# può entrare subito. Chi riscrive users (seed, cambio password) chiama _invalidate_user_lookup;
+# il TTL breve limita l'effetto delle scritture fatte da altri processi.
+_SQL_USER_BY_CODICE = """
+    SELECT user_id, codice_cliente, display_name, password_hash
+    FROM users
+    WHERE codice_cliente = ?
+"""
+_USER_LOOKUP_TTL = 10.0
+_USER_LOOKUP_MAXSIZE = 1024
+_user_lookup_cache: dict[str, tuple[float, tuple]] = {}
+_user_lookup_lock = threading.Lock()
+
+
+def _invalidate_user_lookup() -> None:
+    with _user_lookup_lock:
+        _user_lookup_cache.clear()
+
+
+def _lookup_user_by_codice(codice_cliente: str, *, db: sqlite3.Connection | None = None) -> tuple | None:
+    """Ritorna (user_id, codice_cliente, display_name, password_hash) oppure None."""
+    now = time.monotonic()
+    with _user_lookup_lock:
+        cached = _user_lookup_cache.get(codice_cliente)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    row = (db or get_db()).execute(_SQL_USER_BY_CODICE, (codice_cliente,)).fetchone()
+    if row is None:
+        return None
+    user = tuple(row)
+    with _user_lookup_lock:
+        if len(_user_lookup_cache) >= _USER_LOOKUP_MAXSIZE:
+            _user_lookup_cache.clear()
+        _user_lookup_cache[codice_cliente] = (now + _USER_LOOKUP_TTL, user)
+    return user
+
+
+@lru_cache(maxsize=1)
+def _dummy_password_hash() -> str:
+    """Hash di una password casuale: verificato quando il codice non esiste, così login con codice
+    inesistente e con password errata costano lo stesso (nessun oracolo sui codici validi)."""
+    return generate_password_hash(os.urandom(16).hex(), method=_PASSWORD_HASH_METHOD)
+
+
+def _authenticate(codice_cliente: str, password: str) -> tuple | None:
+    """Utente (come _lookup_user_by_codice) se codice e password sono corretti, altrimenti None."""
+    user = _lookup_user_by_codice(codice_cliente)
+    ok = _verify_password(user[3] if user else _dummy_password_hash(), password)
+    return user if user and ok else None
+
+
+@app.before_request
+def _load_session_user():
+    # letti una volta per richiesta: gli handler usano g invece di rileggere la sessione
+    g.user_id = session.get("user_id")
+    g.display_name = session.get("display_name") or session.get("codice_cliente")
+
+
 def login_required(view_func):
-    from functools import wraps
     @wraps(view_func)
     def wrapped(*args, **kwargs):
-        if not session.get('user_id'):
+        if not g.user_id:
             return redirect(url_for('login', next=request.path))
         return view_func(*args, **kwargs)
     return wrapped
@@ -1003,13 +1701,13 @@ def login_required(view_func):
 # --- Auth Web ---
 @app.route('/')
 def index():
-    if session.get('user_id'):
+    if g.user_id:
         return redirect(url_for('dashboard'))
     return redirect(url_for('login'))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    if session.get('user_id'):
+    if g.user_id:
         return redirect(url_for('dashboard'))
 
     if request.method == 'POST':
@@ -1020,20 +1718,17 @@ def login():
             flash('Inserisci codice utente e password.', 'warning')
             return render_template('login.html')
 
-        db = get_db()
-        user = db.execute(
-            "SELECT user_id, codice_cliente, first_name, last_name, password_hash FROM users WHERE codice_cliente = ?",
-            (codice_cliente,)
-        ).fetchone()
+        user = _authenticate(codice_cliente, password)
 
-        if user and check_password_hash(user['password_hash'], password):
+        if user:
+            user_id, codice, display_name, _ = user
             session.clear()
-            session['user_id'] = user['user_id']
-            session['codice_cliente'] = user['codice_cliente']
-            session['display_name'] = f"{user['first_name']} {user['last_name']}".strip()
-            _ensure_user_settings(user['user_id'])
+            session['user_id'] = user_id
+            session['codice_cliente'] = codice
+            session['display_name'] = display_name
+            _ensure_user_settings(user_id)
             _ensure_notification(
-                user_id=user['user_id'],
+                user_id=user_id,
                 type_='LOGIN',
                 title='Nuovo accesso eseguito',
                 body='Login completato con successo.',
@@ -1054,82 +1749,91 @@ def logout():
     return redirect(url_for('login'))
 
 # --- Dashboard & Notifications ---
+_SQL_DASHBOARD_ACCOUNTS = """
+    SELECT account_id, name, iban, currency, balance
+    FROM accounts
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+"""
+
+_SQL_DASHBOARD_PIGGIES = """
+    SELECT piggy_id, name, target_amount, current_amount, status
+    FROM piggy_banks
+    WHERE user_id = ? AND status != 'DELETED'
+    ORDER BY created_at DESC
+"""
+
+# Conti, salvadanai e ultime 10 transazioni della dashboard in un solo round trip: "kind"
+# (0 conti, 1 salvadanai, 2 transazioni) dice a quale blocco appartiene ogni riga, k1/k2
+# ripetono dentro ogni blocco l'ordinamento delle query singole qui sopra.
+_SQL_DASHBOARD = """
+    SELECT 0 AS kind, account_id, name, iban, currency, balance, NULL, NULL,
+           created_at AS k1, NULL AS k2
+    FROM accounts
+    WHERE user_id = ?1
+    UNION ALL
+    SELECT 1, piggy_id, name, target_amount, current_amount, status, NULL, NULL, created_at, NULL
+    FROM piggy_banks
+    WHERE user_id = ?1 AND status != 'DELETED'
+    UNION ALL
+    SELECT * FROM (
+        SELECT 2, t.transaction_id, t.date, t.description, t.category, t.type, t.amount,
+               a.name, t.date, t.created_at
+        FROM transactions t
+        JOIN accounts a ON a.account_id = t.account_id
+        WHERE a.user_id = ?1
+        ORDER BY t.date DESC, t.created_at DESC
+        LIMIT 10
+    )
+    ORDER BY kind, k1 DESC, k2 DESC
+"""
+
+# Nomi delle colonne 1..7 di _SQL_DASHBOARD per ciascun blocco
+_DASHBOARD_KEYS = (
+    ("account_id", "name", "iban", "currency", "balance"),
+    ("piggy_id", "name", "target_amount", "current_amount", "status"),
+    ("transaction_id", "date", "description", "category", "type", "amount", "account_name"),
+)
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     db = get_db()
-    user_id = session.get('user_id')
+    user_id = g.user_id
 
-    accounts = db.execute("""
-        SELECT account_id, name, iban, currency, balance
-        FROM accounts
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    """, (user_id,)).fetchall()
-
-    piggies = db.execute("""
-        SELECT piggy_id, name, target_amount, current_amount, status
-        FROM piggy_banks
-        WHERE user_id = ? AND status != 'DELETED'
-        ORDER BY created_at DESC
-    """, (user_id,)).fetchall()
-
-    transactions = db.execute("""
-        SELECT t.transaction_id, t.date, t.description, t.category, t.type, t.amount, a.name AS account_name
-        FROM transactions t
-        JOIN accounts a ON a.account_id = t.account_id
-        WHERE a.user_id = ?
-        ORDER BY date DESC, t.created_at DESC
-        LIMIT 10
-    """, (user_id,)).fetchall()
+    accounts, piggies, transactions = blocks = ([], [], [])
+    for row in db.execute(_SQL_DASHBOARD, (user_id,)):
+        keys = _DASHBOARD_KEYS[row[0]]
+        blocks[row[0]].append(dict(zip(keys, row[1:len(keys) + 1])))
 
     settings = _get_user_settings(user_id)
 
-    dash_payload = {
+    # Dati per i grafici di dashboard.js, serializzati qui una volta sola (stesso escaping del
+    # filtro tojson, così il template li inserisce nel <script> senza ricodificarli).
+    dash_payload = htmlsafe_json_dumps({
         "account": {
             "name": (accounts[0]["name"] if accounts else None),
             "balance": float(accounts[0]["balance"] if accounts else 0.0),
             "currency": accounts[0]["currency"] if accounts else "EUR",
         },
         "piggies": [
-            {
-                "name": p["name"],
-                "current": float(p["current_amount"] or 0.0),
-                "target": float(p["target_amount"] or 0.0),
-            }
+            {"name": p["name"], "current": float(p["current_amount"] or 0.0), "target": float(p["target_amount"] or 0.0)}
             for p in piggies
         ],
         "transactions": [
-            {
-                "date": t["date"],
-                "amount": float(t["amount"] or 0.0),
-            }
+            {"date": t["date"], "amount": float(t["amount"] or 0.0)}
             for t in transactions
         ],
-    }
+    }, dumps=app.json.dumps)
 
     # Notifica se un salvadanaio raggiunge il target
-    for piggy in piggies:
-        target = piggy['target_amount']
-        current = float(piggy['current_amount'] or 0.0)
-        if target and current >= float(target) - 1e-6:
-            _ensure_notification(
-                user_id=user_id,
-                type_='PIGGY_TARGET',
-                title=f"Obiettivo '{piggy['name']}' raggiunto",
-                body=f"Hai accumulato {current:.2f}€ su un target di {float(target):.2f}€.",
-                dedupe_key=f"piggy:target:{piggy['piggy_id']}",
-                payload={'piggy_id': piggy['piggy_id'], 'current': current, 'target': float(target)},
-            )
-        else:
-            _clear_notification_by_dedupe(user_id=user_id, dedupe_key=f"piggy:target:{piggy['piggy_id']}")
+    _sync_piggy_target_notifications(user_id, piggies, db=db)
 
-    notifications = _list_notifications(user_id, limit=10)
-    unread_count = _count_unread_notifications(user_id)
+    notifications, unread_count = _list_notifications_with_unread(user_id, limit=10, db=db)
 
     return render_template(
         'dashboard.html',
-        display_name=session.get('display_name') or session.get('codice_cliente'),
+        display_name=g.display_name,
         codice_cliente=session.get('codice_cliente'),
         accounts=accounts,
         piggies=piggies,
@@ -1144,7 +1848,7 @@ def dashboard():
 @app.route('/notifications', methods=['GET', 'POST'])
 @login_required
 def notifications_center():
-    user_id = session['user_id']
+    user_id = g.user_id
     if request.method == 'POST':
         notification_id = request.form.get('notification_id')
         action = (request.form.get('action') or 'read').upper()
@@ -1156,8 +1860,8 @@ def notifications_center():
         return redirect(url_for('notifications_center'))
 
     status_filter = request.args.get('status')
-    items = _list_notifications(user_id, limit=50, status=status_filter if status_filter in {'READ', 'UNREAD'} else None)
-    unread_count = _count_unread_notifications(user_id)
+    items, unread_count = _list_notifications_with_unread(
+        user_id, limit=50, status=status_filter if status_filter in {'READ', 'UNREAD'} else None)
     return render_template(
         'notifications.html',
         notifications=items,
@@ -1181,15 +1885,16 @@ def notifications_center():
 })
 @login_required
 def api_notifications():
-    user_id = session['user_id']
+    user_id = g.user_id
     status_filter = request.args.get('status')
     limit = request.args.get('limit', 10)
     try:
         limit_int = max(1, min(int(limit), 100))
     except (TypeError, ValueError):
         limit_int = 10
-    items = _list_notifications(user_id, limit=limit_int, status=status_filter if status_filter in {'READ', 'UNREAD'} else None)
-    return jsonify({'items': items, 'unread': _count_unread_notifications(user_id)})
+    items, unread_count = _list_notifications_with_unread(
+        user_id, limit=limit_int, status=status_filter if status_filter in {'READ', 'UNREAD'} else None)
+    return jsonify({'items': items, 'unread': unread_count})
 
 
 @app.post('/api/notifications/<notification_id>')
@@ -1220,7 +1925,7 @@ def api_notifications():
 })
 @login_required
 def api_notification_update(notification_id: str):
-    user_id = session['user_id']
+    user_id = g.user_id
     data = request.get_json(silent=True) or {}
     status = (data.get('status') or 'READ').upper()
     if _mark_notification(user_id, notification_id, 'UNREAD' if status == 'UNREAD' else 'READ'):
@@ -1232,7 +1937,7 @@ def api_notification_update(notification_id: str):
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
-    user_id = session['user_id']
+    user_id = g.user_id
     if request.method == 'POST':
         default_currency = request.form.get('default_currency', 'EUR')
         decimal_places = request.form.get('decimal_places', 2)
@@ -1260,13 +1965,7 @@ def web_piggy_create():
         flash("Inserisci un nome per il salvadanaio.", "warning")
         return redirect(url_for("dashboard"))
 
-    db = get_db()
-    piggy_id = _next_id("PIG", "piggy_banks", "piggy_id")
-    db.execute("""
-        INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
-        VALUES (?, ?, ?, ?, 0, 'ACTIVE')
-    """, (piggy_id, session["user_id"], name, float(target_amount) if target_amount else None))
-    db.commit()
+    piggy_id = _create_piggy(g.user_id, name, float(target_amount) if target_amount else None)
     flash(f"Salvadanaio '{name}' creato (ID {piggy_id}).", "success")
     return redirect(url_for("dashboard"))
 
@@ -1278,13 +1977,9 @@ def web_piggy_transfer():
     direction = request.form.get("direction")  # TO_PIGGY | FROM_PIGGY
     note = request.form.get("note") or None
     amount_str = request.form.get("amount") or "0"
-    when = request.form.get("date") or date.today().isoformat()
+    when = request.form.get("date") or _today_iso()
     tx_on_account = True if request.form.get("create_account_tx") == "on" else False
 
-    if not _ensure_user_owns_piggy(session["user_id"], piggy_id):
-        flash("Salvadanaio non trovato.", "danger")
-        return redirect(url_for("dashboard"))
-
     try:
         amount = float(amount_str)
     except ValueError:
@@ -1297,14 +1992,9 @@ def web_piggy_transfer():
         flash("Direzione non valida.", "danger")
         return redirect(url_for("dashboard"))
 
-    # Guard rail: no negativo
-    current = _get_piggy_balance(piggy_id)
-    if direction == "FROM_PIGGY" and amount > current + 1e-9:
-        flash("Saldo salvadanaio insufficiente.", "danger")
-        return redirect(url_for("dashboard"))
-
+    # proprietà del salvadanaio e guard rail sul saldo sono dentro _insert_piggy_transfer
     try:
-        _insert_piggy_transfer(piggy_id=piggy_id, account_id=account_id, amount=amount,
+        _insert_piggy_transfer(user_id=g.user_id, piggy_id=piggy_id, account_id=account_id, amount=amount,
                                direction=direction, note=note, tx_on_account=tx_on_account, when=when)
         flash("Trasferimento registrato con successo.", "success")
     except ValueError as e:
@@ -1320,27 +2010,29 @@ def web_piggy_delete():
     if not piggy_id or not target_account_id:
         flash("Dati mancanti per eliminare il salvadanaio.", "danger")
         return redirect(url_for("dashboard"))
-    if not _ensure_user_owns_piggy(session["user_id"], piggy_id):
-        flash("Salvadanaio non trovato.", "danger")
-        return redirect(url_for("dashboard"))
 
-    db = get_db()
-    # riversa eventuale saldo residuo
-    saldo = _get_piggy_balance(piggy_id)
-    if saldo > 0:
-        _insert_piggy_transfer(
-            piggy_id=piggy_id,
-            account_id=target_account_id,
-            amount=saldo,
-            direction="FROM_PIGGY",
-            note="Chiusura salvadanaio (rientro fondi)",
-            tx_on_account=True,
-            when=date.today().isoformat()
-        )
+    # verifica di proprietà, riversamento del saldo residuo e chiusura nella stessa transazione
+    with _write_tx() as db:
+        owned = db.execute(_SQL_OWNED_PIGGY_BALANCE, (piggy_id, g.user_id)).fetchone()
+        if not owned:
+            flash("Salvadanaio non trovato.", "danger")
+            return redirect(url_for("dashboard"))
+        saldo = float(owned[0])
+        if saldo > 0:
+            _insert_piggy_transfer(
+                user_id=g.user_id,
+                piggy_id=piggy_id,
+                account_id=target_account_id,
+                amount=saldo,
+                direction="FROM_PIGGY",
+                note="Chiusura salvadanaio (rientro fondi)",
+                tx_on_account=True,
+                when=_today_iso(),
+                db=db,
+            )
 
-    # soft delete per evitare problemi di FK
-    db.execute("UPDATE piggy_banks SET status = 'DELETED' WHERE piggy_id = ? AND user_id = ?", (piggy_id, session["user_id"]))
-    db.commit()
+        # soft delete per evitare problemi di FK
+        db.execute(_SQL_SOFT_DELETE_PIGGY, (piggy_id,))
     flash("Salvadanaio eliminato.", "info")
     return redirect(url_for("dashboard"))
 
@@ -1376,35 +2068,73 @@ def api_login():
     if not codice_cliente or not password:
         return jsonify({"message": "codice_cliente e password sono obbligatori"}), 400
 
-    db = get_db()
-    user = db.execute(
-        "SELECT user_id, codice_cliente, password_hash FROM users WHERE codice_cliente = ?",
-        (codice_cliente,)
-    ).fetchone()
-    if user and check_password_hash(user["password_hash"], password):
-        session["user_id"] = user["user_id"]
-        session["codice_cliente"] = user["codice_cliente"]
+    user = _authenticate(codice_cliente, password)
+    if user:
+        session["user_id"] = user[0]
+        session["codice_cliente"] = user[1]
+        session["display_name"] = user[2]
         return jsonify({"message": "ok"})
     return jsonify({"message": "unauthorized"}), 401
 
 
+# parametro ?format=columns comune agli elenchi serviti da _json_rows
+_SWAGGER_FORMAT_PARAM = {
+    "name": "format", "in": "query",
+    "schema": {"type": "string", "enum": ["columns"]},
+    "description": "columns: risposta colonnare {columns, rows}",
+}
+
 @app.get("/api/accounts")
 @swag_from({
     "summary": "Lista conti correnti",
     "tags": ["Accounts"],
+    "parameters": [_SWAGGER_FORMAT_PARAM],
     "responses": {"200": {"description": "Elenco conti"}, "401": {"description": "Non autenticato"}}
 })
 def api_accounts():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    db = get_db()
-    rows = db.execute("""
-        SELECT account_id, name, iban, currency, balance
-        FROM accounts
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    """, (session["user_id"],)).fetchall()
-    return jsonify([dict(r) for r in rows])
+    # stesso testo SQL della dashboard: un solo statement preparato in cache
+    return _json_rows(_SQL_DASHBOARD_ACCOUNTS, (g.user_id,))
+
+
+# whitelist colonne ordinamento
+_TX_SORT_COLUMNS = {
+    "date": "t.date",
+    "amount": "t.amount",
+    "description": "t.description",
+    "category": "t.category",
+}
+
+
+@lru_cache(maxsize=None)  # al massimo 2^5 combinazioni di filtri x 4 colonne x 2 direzioni
+def _api_transactions_sql(by_account: bool, by_type: bool, by_text: bool, by_from: bool, by_to: bool,
+                          sort: str, ascending: bool) -> str:
+    """SQL di /api/transactions per una combinazione di filtri: sempre la stessa stringa, quindi
+    sqlite3 riusa lo statement già preparato. I filtri assenti restano fuori dalla WHERE
+    (niente "? IS NULL OR ...") così il planner può usare gli indici su account_id/date."""
+    where = ["a.user_id = ?"]
+    if by_account:
+        where.append("t.account_id = ?")
+    if by_type:
+        where.append("t.type = ?")
+    if by_text:
+        where.append("(t.description LIKE ? OR t.category LIKE ?)")
+    if by_from:
+        where.append("t.date >= ?")
+    if by_to:
+        where.append("t.date <= ?")
+    sort_col = _TX_SORT_COLUMNS[sort]
+    order_sql = "ASC" if ascending else "DESC"
+    return f"""
+        SELECT t.transaction_id, t.date, t.description, t.category, t.type, t.amount,
+               t.account_id, a.name AS account_name
+        FROM transactions t
+        JOIN accounts a ON a.account_id = t.account_id
+        WHERE {' AND '.join(where)}
+        ORDER BY {sort_col} {order_sql}, t.created_at DESC
+        LIMIT ? OFFSET ?
+    """
 
 
 @app.get("/api/transactions")
@@ -1420,12 +2150,13 @@ def api_accounts():
         {"name": "sort", "in": "query", "schema": {"type": "string", "enum": ["date", "amount", "description", "category"]}},
         {"name": "order", "in": "query", "schema": {"type": "string", "enum": ["asc", "desc"]}},
         {"name": "limit", "in": "query", "schema": {"type": "integer", "default": 10, "minimum": 1, "maximum": 200}},
-        {"name": "offset", "in": "query", "schema": {"type": "integer", "default": 0, "minimum": 0}}
+        {"name": "offset", "in": "query", "schema": {"type": "integer", "default": 0, "minimum": 0}},
+        _SWAGGER_FORMAT_PARAM,
     ],
     "responses": {"200": {"description": "OK"}, "401": {"description": "Non autenticato"}}
 })
 def api_transactions():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
 
     account_id = request.args.get("account_id")
@@ -1445,50 +2176,27 @@ def api_transactions():
     except ValueError:
         offset = 0
 
-    # whitelist colonne ordinamento
-    sort_map = {
-        "date": "t.date",
-        "amount": "t.amount",
-        "description": "t.description",
-        "category": "t.category",
-    }
-    sort_col = sort_map.get(sort, "t.date")
-    order_sql = "ASC" if order == "asc" else "DESC"
-
-    where = ["a.user_id = ?"]
-    params = [session["user_id"]]
-
+    params = [g.user_id]
     if account_id:
-        where.append("t.account_id = ?")
         params.append(account_id)
     if tx_type in ("DEBIT", "CREDIT"):
-        where.append("t.type = ?")
         params.append(tx_type)
+    else:
+        tx_type = None
     if q:
-        where.append("(t.description LIKE ? OR t.category LIKE ?)")
         like = f"%{q}%"
         params.extend([like, like])
     if date_from:
-        where.append("t.date >= ?")
         params.append(date_from)
     if date_to:
-        where.append("t.date <= ?")
         params.append(date_to)
-
-    sql = f"""
-        SELECT t.transaction_id, t.date, t.description, t.category, t.type, t.amount,
-               t.account_id, a.name AS account_name
-        FROM transactions t
-        JOIN accounts a ON a.account_id = t.account_id
-        WHERE {' AND '.join(where)}
-        ORDER BY {sort_col} {order_sql}, t.created_at DESC
-        LIMIT ? OFFSET ?
-    """
     params.extend([limit, offset])
 
-    db = get_db()
-    rows = db.execute(sql, params).fetchall()
-    return jsonify([dict(r) for r in rows])
+    if sort not in _TX_SORT_COLUMNS:
+        sort = "date"
+    sql = _api_transactions_sql(bool(account_id), bool(tx_type), bool(q), bool(date_from), bool(date_to),
+                                sort, order == "asc")
+    return _json_rows(sql, params)
 
 
 
@@ -1497,19 +2205,14 @@ def api_transactions():
 @swag_from({
     "summary": "Lista salvadanai",
     "tags": ["PiggyBank"],
+    "parameters": [_SWAGGER_FORMAT_PARAM],
     "responses": {"200": {"description": "OK"}, "401": {"description": "Non autenticato"}}
 })
 def api_piggy_banks():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    db = get_db()
-    rows = db.execute("""
-        SELECT piggy_id, name, target_amount, current_amount, status
-        FROM piggy_banks
-        WHERE user_id = ? AND status != 'DELETED'
-        ORDER BY created_at DESC
-    """, (session["user_id"],)).fetchall()
-    return jsonify([dict(r) for r in rows])
+    # stesso testo SQL della dashboard: un solo statement preparato in cache
+    return _json_rows(_SQL_DASHBOARD_PIGGIES, (g.user_id,))
 
 
 @app.post("/api/piggy/create")
@@ -1520,7 +2223,7 @@ def api_piggy_banks():
     "responses": {"200": {"description": "Creato"}, "400": {"description": "Errore input"}, "401": {"description": "Non autenticato"}}
 })
 def api_piggy_create():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
     data = request.get_json(silent=True) or {}
     name = (data.get("name") or "").strip()
@@ -1532,13 +2235,7 @@ def api_piggy_create():
     except (TypeError, ValueError):
         return jsonify({"message": "target_amount non valido"}), 400
 
-    db = get_db()
-    piggy_id = _next_id("PIG", "piggy_banks", "piggy_id")
-    db.execute("""
-        INSERT INTO piggy_banks (piggy_id, user_id, name, target_amount, current_amount, status)
-        VALUES (?, ?, ?, ?, 0, 'ACTIVE')
-    """, (piggy_id, session["user_id"], name, ta))
-    db.commit()
+    piggy_id = _create_piggy(g.user_id, name, ta)
     return jsonify({"piggy_id": piggy_id, "name": name, "target_amount": ta, "status": "ACTIVE"})
 
 
@@ -1551,7 +2248,7 @@ def api_piggy_create():
     "responses": {"200": {"description": "Creato"}, "400": {"description": "Errore input"}, "401": {"description": "Non autenticato"}}
 })
 def api_piggy_transfer():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
     data = request.get_json(silent=True) or {}
     required = ["transfer_id", "piggy_id", "account_id", "date", "amount", "direction"]
@@ -1562,50 +2259,43 @@ def api_piggy_transfer():
 
     # guard rail
     try:
-        amount = float(data["amount"])
+        amount_cents = _to_cents(float(data["amount"]))
     except (TypeError, ValueError):
         return jsonify({"message": "amount non valido"}), 400
-    current = _get_piggy_balance(data["piggy_id"])
-    projected = current + (amount if data["direction"] == "TO_PIGGY" else -amount)
-    if projected < 0:
-        return jsonify({"message": "saldo salvadanaio insufficiente"}), 400
-
-    db = get_db()
-    db.execute("""
-        INSERT INTO piggy_transfers (transfer_id, piggy_id, account_id, date, amount, direction, note)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(transfer_id) DO NOTHING
-    """, (
-        data["transfer_id"], data["piggy_id"], data["account_id"],
-        data["date"], float(amount), data["direction"], data.get("note")
-    ))
-
-    # aggiorna current_amount e (opzionale) registra anche sul conto
-    _recalc_piggy(data["piggy_id"])
-
-    if data.get("create_account_tx"):
-        tx_id = f"TRX{data['transfer_id'][3:]}" if str(data["transfer_id"]).startswith("TRP") else f"TRX_{data['transfer_id']}"
-        if data["direction"] == "TO_PIGGY":
-            amt = -abs(float(amount))
-            desc = "Trasferimento verso salvadanaio"
-            ttype = "DEBIT"
-        else:
-            amt = abs(float(amount))
-            desc = "Prelievo da salvadanaio"
-            ttype = "CREDIT"
-
-        cur = db.execute("""
-            INSERT INTO transactions (transaction_id, account_id, piggy_id, date, description, category, type, amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(transaction_id) DO NOTHING
-        """, (
-            tx_id, data["account_id"], data["piggy_id"], data["date"],
-            desc, "Risparmio", ttype, amt
-        ))
-        if cur.rowcount:
-            _apply_account_delta(data["account_id"], amt)
-
-    db.commit()
+    try:
+        # movimenti e contatori ID in un'unica transazione con un solo commit; il saldo non
+        # negativo lo impone il trigger trg_piggy_banks_non_negative (nessuna lettura preventiva)
+        with _write_tx() as db:
+            db.execute(_SQL_INSERT_PIGGY_TRANSFER_IF_NEW, (
+                data["transfer_id"], data["piggy_id"], data["account_id"],
+                data["date"], amount_cents / 100, data["direction"], data.get("note")
+            ))
+
+            _sync_id_counter("TRP", data["transfer_id"], db=db)
+
+            # current_amount e saldo conto sono aggiornati dai trigger; (opzionale) registra anche sul conto
+            if data.get("create_account_tx"):
+                tx_id = f"TRX{data['transfer_id'][3:]}" if str(data["transfer_id"]).startswith("TRP") else f"TRX_{data['transfer_id']}"
+                if data["direction"] == "TO_PIGGY":
+                    amt = -abs(amount_cents) / 100
+                    desc = "Trasferimento verso salvadanaio"
+                    ttype = "DEBIT"
+                else:
+                    amt = abs(amount_cents) / 100
+                    desc = "Prelievo da salvadanaio"
+                    ttype = "CREDIT"
+
+                db.execute(_SQL_INSERT_TX_IF_NEW, (
+                    tx_id, data["account_id"], data["piggy_id"], data["date"],
+                    desc, "Risparmio", ttype, amt
+                ))
+                _sync_id_counter("TRX", tx_id, db=db)
+    except sqlite3.IntegrityError as e:
+        if _PIGGY_NEGATIVE_BALANCE in str(e):
+            return jsonify({"message": _PIGGY_NEGATIVE_BALANCE}), 400
+        if "FOREIGN KEY" in str(e):
+            return jsonify({"message": "piggy_id o account_id non valido"}), 400
+        raise
     return jsonify({"message": "ok"})
 
 @app.delete("/api/piggy/<piggy_id>")
@@ -1620,50 +2310,104 @@ def api_piggy_transfer():
     "responses": {"200": {"description": "Eliminato"}, "400": {"description": "Errore"}, "401": {"description": "Non autenticato"}}
 })
 def api_piggy_delete(piggy_id):
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    if not _ensure_user_owns_piggy(session["user_id"], piggy_id):
-        return jsonify({"message": "not found"}), 404
 
     account_id = request.args.get("account_id")
-    saldo = _get_piggy_balance(piggy_id)
-    if saldo > 0 and not account_id:
-        return jsonify({"message": "account_id richiesto per riversare il saldo residuo"}), 400
-
-    if saldo > 0:
-        _insert_piggy_transfer(
-            piggy_id=piggy_id,
-            account_id=account_id,
-            amount=saldo,
-            direction="FROM_PIGGY",
-            note="Chiusura salvadanaio (rientro fondi)",
-            tx_on_account=True,
-            when=date.today().isoformat()
-        )
-    db = get_db()
-    db.execute("UPDATE piggy_banks SET status = 'DELETED' WHERE piggy_id = ? AND user_id = ?", (piggy_id, session["user_id"]))
-    db.commit()
+    with _write_tx() as db:
+        owned = db.execute(_SQL_OWNED_PIGGY_BALANCE, (piggy_id, g.user_id)).fetchone()
+        if not owned:
+            return jsonify({"message": "not found"}), 404
+        saldo = float(owned[0])
+        if saldo > 0 and not account_id:
+            return jsonify({"message": "account_id richiesto per riversare il saldo residuo"}), 400
+        if saldo > 0:
+            _insert_piggy_transfer(
+                user_id=g.user_id,
+                piggy_id=piggy_id,
+                account_id=account_id,
+                amount=saldo,
+                direction="FROM_PIGGY",
+                note="Chiusura salvadanaio (rientro fondi)",
+                tx_on_account=True,
+                when=_today_iso(),
+                db=db,
+            )
+        db.execute(_SQL_SOFT_DELETE_PIGGY, (piggy_id,))
     return jsonify({"message": "deleted"})
 
 # --- API Contacts & Split Groups ---
+# Cache in-process delle risposte di /api/contacts (interrogata ad ogni tasto dal typeahead):
+# (owner, q, versione rubrica) -> (scadenza monotonic, corpo JSON già serializzato).
+# La versione sta in contacts_version ed è incrementata dai trigger su contacts: qualunque
+# scrittura (da questo worker, da un altro processo o da un comando CLI) cambia la chiave,
+# le voci vecchie non combaciano più e scadono da sole.
+_CONTACTS_CACHE_TTL = 30.0
+_CONTACTS_CACHE_MAXSIZE = 4096
+_contacts_cache: dict[tuple[str, str, int], tuple[float, str]] = {}
+_contacts_cache_lock = threading.Lock()
+
+_SQL_CONTACTS_VERSION = "SELECT version FROM contacts_version WHERE owner_user_id = ?"
+
+
+def _invalidate_contacts_cache() -> None:
+    # dopo init-db le versioni ripartono da zero: le voci già in cache tornerebbero valide
+    with _contacts_cache_lock:
+        _contacts_cache.clear()
+
+
+_SQL_API_CONTACTS = """
+    SELECT contact_id, display_name, target_user_id, target_account_id, iban
+    FROM contacts WHERE owner_user_id = ?
+    ORDER BY created_at DESC
+"""
+
+_SQL_API_CONTACTS_SEARCH = """
+    SELECT contact_id, display_name, target_user_id, target_account_id, iban
+    FROM contacts WHERE owner_user_id = ? AND display_name LIKE ?
+    ORDER BY created_at DESC
+"""
+
+_SQL_API_CONTACTS_FTS = """
+    SELECT c.contact_id, c.display_name, c.target_user_id, c.target_account_id, c.iban
+    FROM contacts_fts f
+    JOIN contacts c ON c.rowid = f.rowid
+    WHERE contacts_fts MATCH ? AND c.owner_user_id = ?
+    ORDER BY c.created_at DESC
+"""
+
 @app.get("/api/contacts")
 @swag_from({"summary": "Rubrica contatti P2P", "tags": ["P2P"]})
 def api_contacts():
-    if not session.get("user_id"):
+    user_id = g.user_id
+    if not user_id:
         return jsonify({"message": "unauthenticated"}), 401
     q = (request.args.get("q") or "").strip()
-    params = [session["user_id"]]
-    where = ["owner_user_id = ?"]
-    if q:
-        where.append("display_name LIKE ?")
-        params.append(f"%{q}%")
-    db = get_db()
-    rows = db.execute(f"""
-        SELECT contact_id, display_name, target_user_id, target_account_id, iban
-        FROM contacts WHERE {' AND '.join(where)}
-        ORDER BY created_at DESC
-    """, params).fetchall()
-    return jsonify([dict(r) for r in rows])
+    row = get_db().execute(_SQL_CONTACTS_VERSION, (user_id,)).fetchone()
+    key = (user_id, q, row[0] if row else 0)
+    now = time.monotonic()
+    with _contacts_cache_lock:
+        cached = _contacts_cache.get(key)
+    if cached and cached[0] > now:
+        return app.response_class(cached[1], mimetype="application/json")
+
+    if len(q) >= 3:  # il tokenizer trigram indicizza sottostringhe di almeno 3 caratteri
+        try:
+            # frase FTS5 tra virgolette: gli operatori di MATCH nel testo restano letterali
+            phrase = '"' + q.replace('"', '""') + '"'
+            contacts = _fetch_dicts(_SQL_API_CONTACTS_FTS, (phrase, user_id))
+        except sqlite3.OperationalError:  # db senza contacts_fts (migration 010 non applicata)
+            contacts = _fetch_dicts(_SQL_API_CONTACTS_SEARCH, (user_id, f"%{q}%"))
+    elif q:
+        contacts = _fetch_dicts(_SQL_API_CONTACTS_SEARCH, (user_id, f"%{q}%"))
+    else:
+        contacts = _fetch_dicts(_SQL_API_CONTACTS, (user_id,))
+    body = app.json.dumps(contacts)
+    with _contacts_cache_lock:
+        if len(_contacts_cache) >= _CONTACTS_CACHE_MAXSIZE:
+            _contacts_cache.clear()
+        _contacts_cache[key] = (now + _CONTACTS_CACHE_TTL, body)
+    return app.response_class(body, mimetype="application/json")
 
 
 @app.get("/api/p2p/groups")
@@ -1676,9 +2420,9 @@ def api_contacts():
     }
 })
 def api_split_groups_list():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    groups = _list_split_groups(session["user_id"])
+    groups = _list_split_groups(g.user_id)
     return jsonify({"groups": groups})
 
 
@@ -1707,15 +2451,15 @@ def api_split_groups_list():
     }
 })
 def api_split_groups_create():
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
     data = request.get_json(silent=True) or {}
     name = (data.get("name") or "").strip()
     if not name:
         return jsonify({"message": "name richiesto"}), 400
-    user_id = session["user_id"]
-    group_id = _next_id("SPG", "split_groups", "group_id")
+    user_id = g.user_id
     db = get_db()
+    group_id = _next_id("SPG", "split_groups", "group_id", db=db)
     db.execute(
         """
         INSERT INTO split_groups (group_id, user_id, name)
@@ -1748,12 +2492,12 @@ def api_split_groups_create():
     }
 })
 def api_split_groups_delete(group_id: str):
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
     db = get_db()
     res = db.execute(
         "DELETE FROM split_groups WHERE group_id = ? AND user_id = ?",
-        (group_id, session["user_id"]),
+        (group_id, g.user_id),
     )
     if res.rowcount == 0:
         return jsonify({"message": "not found"}), 404
@@ -1791,9 +2535,9 @@ def api_split_groups_delete(group_id: str):
     }
 })
 def api_split_groups_add_member(group_id: str):
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    user_id = session["user_id"]
+    user_id = g.user_id
     group = _get_split_group(user_id, group_id)
     if not group:
         return jsonify({"message": "not found"}), 404
@@ -1807,21 +2551,19 @@ def api_split_groups_add_member(group_id: str):
     if not contact["target_user_id"] or not contact["target_account_id"]:
         return jsonify({"message": "il contatto selezionato non supporta richieste P2P interne"}), 400
     db = get_db()
-    dup = db.execute(
-        "SELECT 1 FROM split_group_members WHERE group_id = ? AND contact_id = ?",
-        (group_id, contact_id),
-    ).fetchone()
-    if dup:
-        return jsonify({"message": "contatto già nel gruppo"}), 409
-    member_id = _next_id("SPM", "split_group_members", "member_id")
-    db.execute(
+    # il duplicato lo intercetta UNIQUE (group_id, contact_id): niente SELECT preventiva
+    member_id = _next_id("SPM", "split_group_members", "member_id", db=db)
+    inserted = db.execute(
         """
         INSERT INTO split_group_members (member_id, group_id, contact_id, display_name)
         VALUES (?, ?, ?, ?)
+        ON CONFLICT(group_id, contact_id) DO NOTHING
         """,
         (member_id, group_id, contact_id, contact["display_name"]),
-    )
+    ).rowcount
     db.commit()
+    if not inserted:
+        return jsonify({"message": "contatto già nel gruppo"}), 409
     return jsonify({
         "message": "added",
         "member": {
@@ -1847,9 +2589,9 @@ def api_split_groups_add_member(group_id: str):
     }
 })
 def api_split_groups_remove_member(group_id: str, member_id: str):
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    user_id = session["user_id"]
+    user_id = g.user_id
     group = _get_split_group(user_id, group_id)
     if not group:
         return jsonify({"message": "not found"}), 404
@@ -1895,9 +2637,9 @@ def api_split_groups_remove_member(group_id: str, member_id: str):
     }
 })
 def api_split_groups_split(group_id: str):
-    if not session.get("user_id"):
+    if not g.user_id:
         return jsonify({"message": "unauthenticated"}), 401
-    user_id = session["user_id"]
+    user_id = g.user_id
     group = _get_split_group(user_id, group_id)
     if not group:
         return jsonify({"message": "not found"}), 404
@@ -1908,125 +2650,140 @@ def api_split_groups_split(group_id: str):
     if mode not in {"send", "request"}:
         return jsonify({"message": "mode deve essere 'send' o 'request'"}), 400
     try:
-        amount = Decimal(str(raw_amount))
-    except (TypeError, ValueError, InvalidOperation):
+        # unico passaggio da Decimal (arrotondamento al centesimo), poi solo interi
+        total_cents = _to_cents(raw_amount)
+    except (TypeError, ValueError):
         return jsonify({"message": "amount non valido"}), 400
-    if amount <= 0:
+    if total_cents <= 0:
         return jsonify({"message": "amount deve essere > 0"}), 400
 
     members = _get_split_members(user_id, group_id)
     if not members:
         return jsonify({"message": "il gruppo non ha membri"}), 400
 
-    shares = _split_even(amount, len(members))
+    shares = _split_even_cents(total_cents, len(members))
     results = []
-    owner_name = session.get("display_name") or session.get("codice_cliente") or "Utente"
+    owner_name = g.display_name or "Utente"
 
     if mode == "send":
         from_account_id = data.get("from_account_id")
         if not from_account_id:
             return jsonify({"message": "from_account_id richiesto per mode=send"}), 400
         db = get_db()
-        account = db.execute(
-            "SELECT balance FROM accounts WHERE account_id = ? AND user_id = ?",
-            (from_account_id, user_id),
-        ).fetchone()
-        if not account:
-            return jsonify({"message": "conto mittente non valido"}), 400
-        total_out = sum(shares)
-        balance = Decimal(str(account["balance"] or 0))
-        if balance < total_out:
-            return jsonify({"message": "saldo insufficiente per coprire tutte le quote"}), 400
-
-        for row, share in zip(members, shares):
-            share_float = float(share)
-            try:
-                p2p_id = _p2p_instant(
-                    from_account_id=from_account_id,
-                    to_account_id=row["target_account_id"],
-                    amount=share_float,
-                    message=message,
-                    from_user_id=user_id,
-                    to_user_id=row["target_user_id"],
-                    to_name=row["display_name"],
-                    from_name=owner_name,
-                )
-            except ValueError as exc:
-                return jsonify({"message": str(exc)}), 400
-            _ensure_user_settings(row["target_user_id"])
-            _ensure_notification(
-                user_id=user_id,
-                type_="P2P_SENT",
-                title="Trasferimento inviato",
-                body=f"Hai inviato {share_float:.2f}€ a {row['display_name']} per {group['name']}.",
-                dedupe_key=f"p2p:split:sent:{p2p_id}",
-                payload={
-                    "p2p_id": p2p_id,
-                    "group_id": group_id,
-                    "amount": share_float,
-                    "member_id": row["member_id"],
-                },
+        # Tutte le quote, le preferenze di default dei destinatari e le notifiche in un'unica
+        # transazione: o partono tutte o nessuna. Il controllo del saldo avviene già sotto il
+        # lock di scrittura, così nessun altro invio può eroderlo fra verifica e addebiti.
+        # Le dedupe_key contengono il p2p_id appena creato, quindi sono sempre nuove: niente upsert.
+        notif_rows = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            account = db.execute(
+                "SELECT balance FROM accounts WHERE account_id = ? AND user_id = ?",
+                (from_account_id, user_id),
+            ).fetchone()
+            if not account:
+                raise ValueError("conto mittente non valido")
+            if _to_cents(account["balance"] or 0) < sum(shares):
+                raise ValueError("saldo insufficiente per coprire tutte le quote")
+            db.executemany(_SQL_USER_SETTINGS_DEFAULTS, [(member[2],) for member in members])
+            p2p_ids = _p2p_instant_bulk(
+                from_account_id=from_account_id,
+                from_user_id=user_id,
+                from_name=owner_name,
+                message=message,
+                sends=[(member[3], member[2], member[4], share) for member, share in zip(members, shares)],
+                db=db,
+                commit=False,
             )
-            _ensure_notification(
-                user_id=row["target_user_id"],
-                type_="P2P_RECEIVED",
-                title="Hai ricevuto un trasferimento",
-                body=f"{owner_name} ti ha inviato {share_float:.2f}€ (gruppo {group['name']}).",
-                dedupe_key=f"p2p:split:recv:{p2p_id}",
-                payload={
-                    "p2p_id": p2p_id,
-                    "group_id": group_id,
+            for member, share, p2p_id in zip(members, shares, p2p_ids):
+                member_id, contact_id, target_user_id, target_account_id, display_name = member
+                share_float = share / 100
+                notif_rows.append((
+                    user_id, "P2P_SENT", "Trasferimento inviato",
+                    f"Hai inviato {share_float:.2f}€ a {display_name} per {group['name']}.",
+                    f"p2p:split:sent:{p2p_id}",
+                    _json_dumps({
+                        "p2p_id": p2p_id,
+                        "group_id": group_id,
+                        "amount": share_float,
+                        "member_id": member_id,
+                    }),
+                ))
+                notif_rows.append((
+                    target_user_id, "P2P_RECEIVED", "Hai ricevuto un trasferimento",
+                    f"{owner_name} ti ha inviato {share_float:.2f}€ (gruppo {group['name']}).",
+                    f"p2p:split:recv:{p2p_id}",
+                    _json_dumps({
+                        "p2p_id": p2p_id,
+                        "group_id": group_id,
+                        "amount": share_float,
+                    }),
+                ))
+                results.append({
+                    "member_id": member_id,
+                    "contact_id": contact_id,
+                    "display_name": display_name,
                     "amount": share_float,
-                },
-            )
-            results.append({
-                "member_id": row["member_id"],
-                "contact_id": row["contact_id"],
-                "display_name": row["display_name"],
-                "amount": round(share_float, 2),
-                "status": "sent",
-                "p2p_id": p2p_id,
-            })
+                    "status": "sent",
+                    "p2p_id": p2p_id,
+                })
+            notif_ids = _next_ids("NOT", "notifications", "notification_id", len(notif_rows), db=db)
+            db.executemany(_SQL_INSERT_NOTIFICATION,
+                           [(nid, *notif) for nid, notif in zip(notif_ids, notif_rows)])
+            db.commit()
+        except ValueError as exc:
+            db.rollback()
+            return jsonify({"message": str(exc)}), 400
+        except Exception:
+            db.rollback()
+            raise
         return jsonify({"message": "sent", "results": results, "mode": mode})
 
-    for row, share in zip(members, shares):
-        share_float = float(share)
-        _ensure_user_settings(row["target_user_id"])
-        notif_id = _ensure_notification(
-            user_id=row["target_user_id"],
-            type_="P2P_REQUEST",
-            title=f"Richiesta rimborso gruppo {group['name']}",
-            body=f"{owner_name} chiede {share_float:.2f}€ per una spesa condivisa.",
-            payload={
+    db = get_db()
+    db.executemany(_SQL_USER_SETTINGS_DEFAULTS, [(member[2],) for member in members])
+
+    # Le richieste non hanno dedupe_key: un solo executemany per tutte, più il riepilogo al mittente
+    notif_rows = []
+    for member, share in zip(members, shares):
+        member_id, contact_id, target_user_id, target_account_id, display_name = member
+        share_float = share / 100
+        notif_rows.append((
+            target_user_id, "P2P_REQUEST", f"Richiesta rimborso gruppo {group['name']}",
+            f"{owner_name} chiede {share_float:.2f}€ per una spesa condivisa.",
+            None,
+            _json_dumps({
                 "group_id": group_id,
                 "origin_user": user_id,
                 "amount": share_float,
                 "message": message,
-            },
-        )
+            }),
+        ))
         results.append({
-            "member_id": row["member_id"],
-            "contact_id": row["contact_id"],
-            "display_name": row["display_name"],
-            "amount": round(share_float, 2),
+            "member_id": member_id,
+            "contact_id": contact_id,
+            "display_name": display_name,
+            "amount": share_float,
             "status": "requested",
-            "notification_id": notif_id,
         })
-
-    _ensure_notification(
-        user_id=user_id,
-        type_="P2P_REQUEST",
-        title=f"Richieste inviate per {group['name']}",
-        body=f"Hai chiesto {float(amount):.2f}€ da {len(members)} persone.",
-        payload={"group_id": group_id, "amount": float(amount)},
-    )
+    notif_rows.append((
+        user_id, "P2P_REQUEST", f"Richieste inviate per {group['name']}",
+        f"Hai chiesto {total_cents / 100:.2f}€ da {len(members)} persone.",
+        None,
+        _json_dumps({"group_id": group_id, "amount": total_cents / 100}),
+    ))
+    notif_ids = _next_ids("NOT", "notifications", "notification_id", len(notif_rows), db=db)
+    db.executemany(_SQL_INSERT_NOTIFICATION, [(nid, *notif) for nid, notif in zip(notif_ids, notif_rows)])
+    db.commit()
+    for result, notif_id in zip(results, notif_ids):
+        result["notification_id"] = notif_id
     return jsonify({"message": "requested", "results": results, "mode": mode})
 
 # --- API P2P Transfers ---
 @app.post("/api/p2p/send")
 @swag_from({"summary": "Invio P2P interno istantaneo", "tags": ["P2P"], "requestBody": {"required": True}})
 def api_p2p_send():
-    if not session.get("user_id"):
+    user_id = g.user_id
+    if not user_id:
         return jsonify({"message": "unauthenticated"}), 401
 
     data = request.get_json(silent=True) or {}
@@ -2039,11 +2796,13 @@ def api_p2p_send():
     if not from_account_id or not contact_id or amount is None:
         return jsonify({"message": "campi richiesti: from_account_id, contact_id, amount"}), 400
     try:
-        amount = float(amount)
+        # importo normalizzato al centesimo una volta sola: è quello registrato da _p2p_instant,
+        # e lo stesso finisce in notifiche e risposta
+        amount = _to_cents(float(amount)) / 100
     except (TypeError, ValueError):
         return jsonify({"message": "amount non valido"}), 400
 
-    contact = _ensure_contact(session["user_id"], contact_id)
+    contact = _ensure_contact(user_id, contact_id)
     if not contact or not contact["target_user_id"] or not contact["target_account_id"]:
         return jsonify({"message": "contatto non valido o non interno"}), 400
     if amount <= 0:
@@ -2051,9 +2810,9 @@ def api_p2p_send():
 
     db = get_db()
     owner = db.execute("SELECT user_id FROM accounts WHERE account_id = ?", (from_account_id,)).fetchone()
-    if not owner or owner["user_id"] != session["user_id"]:
+    if not owner or owner["user_id"] != user_id:
         return jsonify({"message": "conto mittente non valido"}), 400
-    if contact["target_user_id"] == session["user_id"]:
+    if contact["target_user_id"] == user_id:
         return jsonify({"message": "non puoi inviare a te stess*"}), 400
 
     try:
@@ -2062,28 +2821,33 @@ def api_p2p_send():
             to_account_id=contact["target_account_id"],
             amount=amount,
             message=message,
-            from_user_id=session["user_id"],
+            from_user_id=user_id,
             to_user_id=contact["target_user_id"],
             to_name=to_name,
             from_name=session.get("display_name")  # opzionale
         )
+        if contact['target_user_id']:
+            _ensure_user_settings(contact['target_user_id'])
+        # le due notifiche finiscono nello stesso commit
         _ensure_notification(
-            user_id=session['user_id'],
+            user_id=user_id,
             type_='P2P_SENT',
             title='Trasferimento inviato',
             body=f"Hai inviato {amount:.2f}€ a {to_name or contact['display_name']}.",
             dedupe_key=f"p2p:sent:{p2p_id}",
             payload={'p2p_id': p2p_id, 'amount': amount, 'contact_id': contact_id},
+            db=db,
+            commit=not contact['target_user_id'],
         )
         if contact['target_user_id']:
-            _ensure_user_settings(contact['target_user_id'])
             _ensure_notification(
                 user_id=contact['target_user_id'],
                 type_='P2P_RECEIVED',
                 title='Hai ricevuto un trasferimento',
-                body=f"{session.get('display_name') or session.get('codice_cliente')} ti ha inviato {amount:.2f}€.",
+                body=f"{g.display_name} ti ha inviato {amount:.2f}€.",
                 dedupe_key=f"p2p:recv:{p2p_id}",
-                payload={'p2p_id': p2p_id, 'amount': amount, 'from_user': session.get('user_id')},
+                payload={'p2p_id': p2p_id, 'amount': amount, 'from_user': user_id},
+                db=db,
             )
         return jsonify({"message": "ok", "p2p_id": p2p_id, "to_name": to_name, "amount": amount})
     except ValueError as e:
@@ -2093,71 +2857,121 @@ def api_p2p_send():
 # --- Reports Helpers ---
 
 def _date_from_months(months: int) -> str:
-    """Ritorna la data (YYYY-MM-DD) spostata indietro di 'months' mesi circa (30 giorni * n)."""
-    days = max(1, int(months) * 30)
-    d = (datetime.utcnow() - timedelta(days=days)).date()
-    return d.isoformat()
+    """Ritorna la data (YYYY-MM-DD) di 'months' mesi di calendario fa, stesso giorno del mese
+    (limitato all'ultimo giorno del mese di arrivo, es. 31/03 - 1 mese -> 28/02)."""
+    today = date.fromisoformat(_today_iso())  # stessa data usata per i movimenti della richiesta
+    year, month0 = divmod(today.year * 12 + today.month - 1 - max(1, int(months)), 12)
+    day = min(today.day, calendar.monthrange(year, month0 + 1)[1])
+    return f"{year:04d}-{month0 + 1:02d}-{day:02d}"
+
+# Tutti i dati del report in un solo round trip: la CTE tx (movimenti del periodo esclusi i
+# salvadanai) alimenta sia la serie mensile sia le categorie; "kind" dice a quale blocco
+# appartiene ogni riga. L'ordinamento dei blocchi si fa in Python.
+# Il mese (YYYYMM intero) si calcola da t.date: la CTE legge solo colonne di idx_trx_report,
+# indice coprente e parziale su piggy_id IS NULL, senza mai toccare la tabella.
+_SQL_REPORT_SUMMARY = """
+    WITH tx AS (
+        SELECT CAST(substr(t.date, 1, 4) AS INTEGER) * 100 + CAST(substr(t.date, 6, 2) AS INTEGER) AS ym,
+               t.category, t.type, t.amount
+        FROM transactions t
+        JOIN accounts a ON a.account_id = t.account_id
+        WHERE a.user_id = ?1
+          AND t.date >= ?2
+          AND t.piggy_id IS NULL      -- <<< esclude movimenti legati ai salvadanai
+    )
+    SELECT 'month' AS kind, ym AS label,
+           SUM(CASE WHEN type='CREDIT' THEN amount ELSE 0 END) AS v1,
+           SUM(CASE WHEN type='DEBIT'  THEN -amount ELSE 0 END) AS v2
+    FROM tx
+    GROUP BY ym
+    UNION ALL
+    SELECT 'category', category, SUM(-amount), NULL
+    FROM tx
+    WHERE type='DEBIT'
+    GROUP BY category
+    HAVING SUM(-amount) > 0
+    UNION ALL
+    SELECT 'accounts', NULL, COALESCE(SUM(balance),0), NULL
+    FROM accounts
+    WHERE user_id = ?1
+    UNION ALL
+    SELECT 'piggies', NULL, COALESCE(SUM(current_amount),0), NULL
+    FROM piggy_banks
+    WHERE user_id = ?1 AND status != 'DELETED'
+"""
+
+# Impronta dei dati del report: ogni INSERT in transactions alza MAX(rowid) e ogni movimento
+# sposta i saldi (trigger), quindi basta confrontarla per sapere se il report è ancora valido.
+_SQL_REPORT_STAMP = """
+    SELECT (SELECT MAX(rowid) FROM transactions),
+           (SELECT COALESCE(SUM(balance), 0) FROM accounts WHERE user_id = ?1),
+           (SELECT COALESCE(SUM(current_amount), 0) FROM piggy_banks WHERE user_id = ?1 AND status != 'DELETED')
+"""
+
+# Cache in-process dei report (aggregati sul periodo, ricalcolati ad ogni apertura di /reports):
+# (user, mesi, data di inizio, impronta) -> (scadenza monotonic, report). Un'impronta diversa
+# non combacia più con le voci vecchie, che scadono da sole; i report in cache sono di sola lettura.
+_REPORT_CACHE_TTL = 60.0
+_REPORT_CACHE_MAXSIZE = 1024
+_report_cache: dict[tuple, tuple[float, dict]] = {}
+_report_cache_lock = threading.Lock()
+
 
 def _report_summary(user_id: str, months: int = 3):
-    """Calcola metriche e dataset per la pagina report."""
+    """Metriche e dataset per la pagina report, dalla cache se i dati dell'utente non sono cambiati."""
     db = get_db()
     since = _date_from_months(months)
-
-    # Serie mensile: entrate/uscite (positive)
-    monthly = db.execute("""
-        SELECT strftime('%Y-%m', t.date) AS ym,
-               SUM(CASE WHEN t.type='CREDIT' THEN t.amount ELSE 0 END) AS inc_raw,
-               SUM(CASE WHEN t.type='DEBIT'  THEN -t.amount ELSE 0 END) AS exp_raw
-        FROM transactions t
-        JOIN accounts a ON a.account_id = t.account_id
-        WHERE a.user_id = ?
-          AND t.date >= ?
-          AND t.piggy_id IS NULL      -- <<< esclude movimenti legati ai salvadanai
-        GROUP BY ym
-        ORDER BY ym
-    """, (user_id, since)).fetchall()
-    monthly_data = [{
-        "month": r["ym"],
-        "income": float(r["inc_raw"] or 0.0),
-        "expenses": float(r["exp_raw"] or 0.0),
-    } for r in monthly]
-
-    # Spese per categoria
-    by_cat = db.execute("""
-        SELECT t.category,
-               SUM(-t.amount) AS spent
-        FROM transactions t
-        JOIN accounts a ON a.account_id = t.account_id
-        WHERE a.user_id = ?
-          AND t.date >= ?
-          AND t.type='DEBIT'
-          AND t.piggy_id IS NULL      -- <<< esclude movimenti salvadanaio
-        GROUP BY t.category
-        HAVING spent > 0
-        ORDER BY spent DESC
-    """, (user_id, since)).fetchall()
-    categories = [{"category": r["category"] or "Altro", "amount": float(r["spent"] or 0.0)} for r in by_cat]
-
-    # Totali periodo
-    period_income = sum(m["income"] for m in monthly_data)
-    period_expenses = sum(m["expenses"] for m in monthly_data)
-
-    # Medie mensili (se non ci sono dati, evita divisoni)
-    n_months = max(1, len({m["month"] for m in monthly_data}) or months)
+    key = (user_id, months, since, tuple(db.execute(_SQL_REPORT_STAMP, (user_id,)).fetchone()))
+    now = time.monotonic()
+    with _report_cache_lock:
+        cached = _report_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    data = _compute_report_summary(user_id, months, since, db=db)
+    with _report_cache_lock:
+        if len(_report_cache) >= _REPORT_CACHE_MAXSIZE:
+            _report_cache.clear()
+        _report_cache[key] = (now + _REPORT_CACHE_TTL, data)
+    return data
+
+
+def _compute_report_summary(user_id: str, months: int, since: str, *, db: sqlite3.Connection):
+    """Calcola metriche e dataset per la pagina report."""
+    monthly_data = []   # serie mensile: entrate/uscite (positive)
+    categories = []     # spese per categoria
+    acc_sum = piggy_sum = 0.0
+    for kind, label, v1, v2 in db.execute(_SQL_REPORT_SUMMARY, (user_id, since)):
+        if kind == "month":
+            year, month = divmod(label, 100)  # YYYYMM, es. 202510 -> "2025-10"
+            monthly_data.append({"month": f"{year:04d}-{month:02d}", "income": float(v1 or 0.0), "expenses": float(v2 or 0.0)})
+        elif kind == "category":
+            categories.append({"category": label or "Altro", "amount": float(v1 or 0.0)})
+        elif kind == "accounts":
+            acc_sum = v1 or 0.0
+        else:
+            piggy_sum = v1 or 0.0
+    monthly_data.sort(key=lambda m: m["month"] or "")
+    categories.sort(key=lambda c: c["amount"], reverse=True)
+
+    # Totali periodo e varianza delle spese mensili in un solo passaggio sulla serie
+    # (varianza con l'aggiornamento di Welford: stabile come il calcolo a due passate)
+    period_income = period_expenses = 0  # come sum(): 0 intero se non ci sono mesi
+    running_mean = exp_m2 = 0.0
+    for i, m in enumerate(monthly_data, 1):
+        expenses = m["expenses"]
+        period_income += m["income"]
+        period_expenses += expenses
+        delta = expenses - running_mean
+        running_mean += delta / i
+        exp_m2 += delta * (expenses - running_mean)
+
+    # Medie mensili (se non ci sono dati, evita divisoni); i mesi sono già distinti (GROUP BY ym)
+    n_months = max(1, len(monthly_data) or months)
     avg_expenses = period_expenses / n_months
     avg_income = period_income / n_months
 
     # Saldi correnti: conto + salvadanai
-    acc_sum = db.execute("""
-        SELECT COALESCE(SUM(balance),0) AS tot
-        FROM accounts
-        WHERE user_id = ?
-    """, (user_id,)).fetchone()["tot"] or 0.0
-    piggy_sum = db.execute("""
-        SELECT COALESCE(SUM(current_amount),0) AS tot
-        FROM piggy_banks
-        WHERE user_id = ? AND status != 'DELETED'
-    """, (user_id,)).fetchone()["tot"] or 0.0
     net_liquid = float(acc_sum) + float(piggy_sum)
 
     # --- Financial wellness score (0-100) ---
@@ -2172,12 +2986,9 @@ def _report_summary(user_id: str, months: int = 3):
     runway_norm = max(0.0, min(1.0, runway_months / 6.0))
 
     # 3) Stabilità spese: 1 - coefficiente di variazione (cap [0..1])
-    import math
-    exp_vals = [m["expenses"] for m in monthly_data] or [avg_expenses]
-    mean = sum(exp_vals) / len(exp_vals)
-    if mean > 0 and len(exp_vals) > 1:
-        var = sum((x - mean) ** 2 for x in exp_vals) / (len(exp_vals) - 1)
-        cv = math.sqrt(var) / mean
+    if len(monthly_data) > 1 and avg_expenses > 0:
+        var = exp_m2 / (len(monthly_data) - 1)
+        cv = math.sqrt(var) / avg_expenses
         stability = max(0.0, min(1.0, 1.0 - cv))  # più vicino a 1 = più stabile
     else:
         stability = 1.0
@@ -2214,7 +3025,7 @@ def reports():
         months_int = max(1, min(int(months), 12))
     except ValueError:
         months_int = 3
-    data = _report_summary(session['user_id'], months=months_int)
+    data = _report_summary(g.user_id, months=months_int)
     return render_template('report.html', report=data, months=months_int)
 
 @app.get('/api/reports/summary')
@@ -2236,7 +3047,7 @@ def api_report_summary():
         months_int = max(1, min(int(months), 12))
     except ValueError:
         months_int = 3
-    data = _report_summary(session['user_id'], months=months_int)
+    data = _report_summary(g.user_id, months=months_int)
     return jsonify(data)
 
 
@@ -2245,13 +3056,8 @@ def api_report_summary():
 @login_required
 def p2p():
     db = get_db()
-    user_id = session["user_id"]
-    accounts = db.execute("""
-        SELECT account_id, name, iban, currency, balance
-        FROM accounts
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    """, (user_id,)).fetchall()
+    user_id = g.user_id
+    accounts = db.execute(_SQL_DASHBOARD_ACCOUNTS, (user_id,)).fetchall()
     contacts = db.execute("""
         SELECT contact_id, display_name, target_user_id, target_account_id
         FROM contacts
@@ -2272,4 +3078,5 @@ def p2p():
 
 # --- Application Entrypoint ---
 if __name__ == '__main__':
+    # solo sviluppo: in produzione gunicorn -w 2 -k gthread --threads 8 app:app (vedi README)
     app.run(debug=True)
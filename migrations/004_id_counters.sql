@@ -0,0 +1,6 @@
+-- Migration 004: contatori per gli ID testuali
+
+CREATE TABLE IF NOT EXISTS id_counters (
+  prefix  TEXT PRIMARY KEY,
+  last_id INTEGER NOT NULL
+);
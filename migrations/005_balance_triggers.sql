@@ -0,0 +1,16 @@
+-- Migration 005: saldi mantenuti da trigger (sostituisce gli UPDATE applicativi)
+
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_ai AFTER INSERT ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      + CASE NEW.direction WHEN 'TO_PIGGY' THEN NEW.amount ELSE -NEW.amount END
+  WHERE piggy_id = NEW.piggy_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_transactions_ai AFTER INSERT ON transactions
+BEGIN
+  UPDATE accounts
+  SET balance = COALESCE(balance, 0) + NEW.amount
+  WHERE account_id = NEW.account_id;
+END;
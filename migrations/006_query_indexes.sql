@@ -0,0 +1,9 @@
+-- Migration 006: indici composti per notifiche, rubrica e movimenti
+
+CREATE INDEX IF NOT EXISTS idx_trx_account_date ON transactions(account_id, date DESC);
+CREATE INDEX IF NOT EXISTS idx_piggy_transfers_piggy ON piggy_transfers(piggy_id, direction);
+CREATE INDEX IF NOT EXISTS idx_contacts_owner_target ON contacts(owner_user_id, target_user_id, target_account_id);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_status  ON notifications(user_id, status, created_at DESC);
+
+ANALYZE;
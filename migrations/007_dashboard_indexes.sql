@@ -0,0 +1,10 @@
+-- Migration 007: indici per le query della dashboard e di /api/transactions
+
+-- sostituisce idx_trx_account_date aggiungendo created_at (ORDER BY date DESC, created_at DESC)
+DROP INDEX IF EXISTS idx_trx_account_date;
+CREATE INDEX IF NOT EXISTS idx_trx_account_date_created ON transactions(account_id, date DESC, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_accounts_user_created ON accounts(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_piggy_user_status_created ON piggy_banks(user_id, status, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_dedupe  ON notifications(user_id, dedupe_key);
+
+ANALYZE;
@@ -0,0 +1,22 @@
+-- Migration 008: dedupe_key univoca per utente (UPSERT in _ensure_notification)
+
+-- le chiavi vuote valevano come "nessuna deduplica"
+UPDATE notifications SET dedupe_key = NULL WHERE dedupe_key = '';
+
+-- tiene solo la notifica più recente per ogni (user_id, dedupe_key) duplicata
+DELETE FROM notifications
+WHERE dedupe_key IS NOT NULL
+  AND notification_id NOT IN (
+    SELECT notification_id FROM (
+      SELECT notification_id,
+             ROW_NUMBER() OVER (PARTITION BY user_id, dedupe_key
+                                ORDER BY created_at DESC, notification_id DESC) AS rn
+      FROM notifications
+      WHERE dedupe_key IS NOT NULL
+    )
+    WHERE rn = 1
+  );
+
+-- sostituisce l'indice non univoco della migration 007
+DROP INDEX IF EXISTS idx_notifications_user_dedupe;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_notifications_user_dedupe ON notifications(user_id, dedupe_key);
@@ -0,0 +1,6 @@
+-- Migration 009: rubrica ordinata per data di creazione (/api/contacts, pagina P2P)
+
+-- owner_user_id + created_at DESC evita il sort; display_name nell'indice fa filtrare il LIKE senza leggere la riga
+CREATE INDEX IF NOT EXISTS idx_contacts_owner_created ON contacts(owner_user_id, created_at DESC, display_name);
+
+ANALYZE;
@@ -0,0 +1,24 @@
+-- Migration 010: ricerca contatti con FTS5 (tokenizer trigram, richiede SQLite >= 3.34)
+
+CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+  display_name, content='contacts', content_rowid='rowid', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_ai AFTER INSERT ON contacts
+BEGIN
+  INSERT INTO contacts_fts(rowid, display_name) VALUES (NEW.rowid, NEW.display_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_ad AFTER DELETE ON contacts
+BEGIN
+  INSERT INTO contacts_fts(contacts_fts, rowid, display_name) VALUES ('delete', OLD.rowid, OLD.display_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_au AFTER UPDATE OF display_name ON contacts
+BEGIN
+  INSERT INTO contacts_fts(contacts_fts, rowid, display_name) VALUES ('delete', OLD.rowid, OLD.display_name);
+  INSERT INTO contacts_fts(rowid, display_name) VALUES (NEW.rowid, NEW.display_name);
+END;
+
+-- indicizza i contatti già presenti
+INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild');
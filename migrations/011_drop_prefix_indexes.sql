@@ -0,0 +1,9 @@
+-- Migration 011: rimuove gli indici coperti da un indice composito con la stessa colonna iniziale
+
+-- transactions(account_id) è il prefisso di idx_trx_account_date_created: ogni insert manteneva
+-- due indici per servire le stesse ricerche; il composito serve anche lo scan ordinato per data
+DROP INDEX IF EXISTS idx_trx_account;
+-- accounts(user_id) è il prefisso di idx_accounts_user_created
+DROP INDEX IF EXISTS idx_accounts_user;
+
+ANALYZE;
@@ -0,0 +1,22 @@
+-- Migration 012: current_amount allineato anche quando un movimento del salvadanaio viene
+-- cancellato o modificato (prima solo l'INSERT aggiornava il saldo, il resto passava da _recalc_piggy)
+
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_ad AFTER DELETE ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      - CASE OLD.direction WHEN 'TO_PIGGY' THEN OLD.amount ELSE -OLD.amount END
+  WHERE piggy_id = OLD.piggy_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_au AFTER UPDATE OF piggy_id, amount, direction ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      - CASE OLD.direction WHEN 'TO_PIGGY' THEN OLD.amount ELSE -OLD.amount END
+  WHERE piggy_id = OLD.piggy_id;
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      + CASE NEW.direction WHEN 'TO_PIGGY' THEN NEW.amount ELSE -NEW.amount END
+  WHERE piggy_id = NEW.piggy_id;
+END;
@@ -0,0 +1,5 @@
+-- Migration 013: nome visualizzato dell'utente come colonna generata (login e seed lo leggono già pronto)
+
+-- colonna VIRTUAL: calcolata in lettura, nessuna riscrittura della tabella
+ALTER TABLE users ADD COLUMN display_name TEXT GENERATED ALWAYS AS
+  (TRIM(first_name || ' ' || last_name)) VIRTUAL;
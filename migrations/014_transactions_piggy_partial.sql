@@ -0,0 +1,8 @@
+-- Migration 014: indice su transactions.piggy_id solo per i movimenti legati a un salvadanaio
+
+-- le ricerche sono sempre piggy_id = ? (mai IS NULL): le righe NULL, la grande maggioranza,
+-- occupavano l'indice e andavano aggiornate a ogni insert senza servire a nessuna query
+DROP INDEX IF EXISTS idx_trx_piggy;
+CREATE INDEX IF NOT EXISTS idx_trx_piggy ON transactions(piggy_id) WHERE piggy_id IS NOT NULL;
+
+ANALYZE;
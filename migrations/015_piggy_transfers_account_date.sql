@@ -0,0 +1,7 @@
+-- Migration 015: movimenti salvadanaio per conto e data
+
+-- la pulizia di seed-demo-12m (account_id = ? AND date >= ?) e il controllo della FK quando si
+-- cancella un conto scansionavano tutta piggy_transfers
+CREATE INDEX IF NOT EXISTS idx_piggy_transfers_account_date ON piggy_transfers(account_id, date);
+
+ANALYZE;
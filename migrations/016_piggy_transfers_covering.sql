@@ -0,0 +1,8 @@
+-- Migration 016: indice coprente per il ricalcolo del saldo dei salvadanai
+
+-- _sum_piggy_transfers somma amount per (piggy_id, direction): con amount nell'indice
+-- le due somme si risolvono senza leggere le righe di piggy_transfers
+DROP INDEX IF EXISTS idx_piggy_transfers_piggy;
+CREATE INDEX IF NOT EXISTS idx_piggy_transfers_piggy ON piggy_transfers(piggy_id, direction, amount);
+
+ANALYZE;
@@ -0,0 +1,12 @@
+-- Migration 017: indici coprenti per il report
+
+-- la CTE del report filtra per conto/data con piggy_id IS NULL e somma amount per type e
+-- category: indice parziale con tutte le colonne lette, nessun accesso alle righe di transactions
+CREATE INDEX IF NOT EXISTS idx_trx_report ON transactions(account_id, date, type, category, amount, piggy_id)
+  WHERE piggy_id IS NULL;
+
+-- il join dei report (a.account_id per a.user_id) servito dall'indice senza lookup sulla tabella
+DROP INDEX IF EXISTS idx_accounts_user_created;
+CREATE INDEX IF NOT EXISTS idx_accounts_user_created ON accounts(user_id, created_at DESC, account_id);
+
+ANALYZE;
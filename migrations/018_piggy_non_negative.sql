@@ -0,0 +1,9 @@
+-- Migration 018: saldo dei salvadanai mai negativo, imposto dal database
+
+-- SQLite non aggiunge CHECK a una tabella esistente senza ricostruirla: un trigger BEFORE UPDATE
+-- blocca ogni scrittura che porterebbe current_amount sotto zero (confronto al centesimo)
+CREATE TRIGGER IF NOT EXISTS trg_piggy_banks_non_negative BEFORE UPDATE OF current_amount ON piggy_banks
+WHEN CAST(ROUND(COALESCE(NEW.current_amount, 0) * 100) AS INTEGER) < 0
+BEGIN
+  SELECT RAISE(ABORT, 'saldo salvadanaio insufficiente');
+END;
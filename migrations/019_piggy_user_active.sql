@@ -0,0 +1,8 @@
+-- Migration 019: indice parziale sui salvadanai non eliminati
+
+-- le liste filtrano con status != 'DELETED' (ACTIVE, PAUSED e CLOSED restano visibili): con (user_id,
+-- status, created_at) la disuguaglianza su status impediva di leggere created_at già ordinato
+DROP INDEX IF EXISTS idx_piggy_user_status_created;
+CREATE INDEX IF NOT EXISTS idx_piggy_user_active ON piggy_banks(user_id, created_at DESC) WHERE status != 'DELETED';
+
+ANALYZE;
@@ -0,0 +1,30 @@
+-- Migration 020: versione della rubrica tenuta dai trigger (chiave della cache di /api/contacts)
+
+-- Versione della rubrica per utente, incrementata dai trigger a ogni scrittura su contacts:
+-- entra nella chiave della cache di /api/contacts, così ogni worker vede subito le modifiche
+CREATE TABLE IF NOT EXISTS contacts_version (
+  owner_user_id TEXT PRIMARY KEY,
+  version       INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_ai AFTER INSERT ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (NEW.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_ad AFTER DELETE ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (OLD.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
+
+-- un UPDATE può spostare il contatto da un utente all'altro: cambiano entrambe le rubriche
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_au AFTER UPDATE ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (OLD.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+  INSERT INTO contacts_version (owner_user_id, version)
+    SELECT NEW.owner_user_id, 1 WHERE NEW.owner_user_id IS NOT OLD.owner_user_id
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
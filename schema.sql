@@ -7,7 +7,9 @@ CREATE TABLE IF NOT EXISTS users (
   first_name     TEXT NOT NULL,
   last_name      TEXT NOT NULL,
   password_hash  TEXT NOT NULL,
-  created_at     TEXT DEFAULT (datetime('now'))
+  created_at     TEXT DEFAULT (datetime('now')),
+  -- nome mostrato in sessione e nei seed, calcolato in lettura (nessuna concatenazione in Python)
+  display_name   TEXT GENERATED ALWAYS AS (TRIM(first_name || ' ' || last_name)) VIRTUAL
 );
 
 
@@ -112,11 +114,123 @@ CREATE TABLE IF NOT EXISTS p2p_transfers (
   FOREIGN KEY (to_account_id) REFERENCES accounts(account_id)
 );
 
+-- Contatori per gli ID testuali (es. TRX → ultimo numero assegnato)
+CREATE TABLE IF NOT EXISTS id_counters (
+  prefix  TEXT PRIMARY KEY,                     -- es. TRX
+  last_id INTEGER NOT NULL                      -- es. 229 → prossimo TRX230
+);
+
+-- Trigger: saldi di salvadanai e conti mantenuti dal database ad ogni movimento
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_ai AFTER INSERT ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      + CASE NEW.direction WHEN 'TO_PIGGY' THEN NEW.amount ELSE -NEW.amount END
+  WHERE piggy_id = NEW.piggy_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_ad AFTER DELETE ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      - CASE OLD.direction WHEN 'TO_PIGGY' THEN OLD.amount ELSE -OLD.amount END
+  WHERE piggy_id = OLD.piggy_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_piggy_transfers_au AFTER UPDATE OF piggy_id, amount, direction ON piggy_transfers
+BEGIN
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      - CASE OLD.direction WHEN 'TO_PIGGY' THEN OLD.amount ELSE -OLD.amount END
+  WHERE piggy_id = OLD.piggy_id;
+  UPDATE piggy_banks
+  SET current_amount = COALESCE(current_amount, 0)
+      + CASE NEW.direction WHEN 'TO_PIGGY' THEN NEW.amount ELSE -NEW.amount END
+  WHERE piggy_id = NEW.piggy_id;
+END;
+
+-- Vincolo "saldo salvadanaio non negativo" nel motore (al centesimo, come i guard-rail in app.py):
+-- copre ogni scrittura di current_amount, trigger dei movimenti inclusi
+CREATE TRIGGER IF NOT EXISTS trg_piggy_banks_non_negative BEFORE UPDATE OF current_amount ON piggy_banks
+WHEN CAST(ROUND(COALESCE(NEW.current_amount, 0) * 100) AS INTEGER) < 0
+BEGIN
+  SELECT RAISE(ABORT, 'saldo salvadanaio insufficiente');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_transactions_ai AFTER INSERT ON transactions
+BEGIN
+  UPDATE accounts
+  SET balance = COALESCE(balance, 0) + NEW.amount
+  WHERE account_id = NEW.account_id;
+END;
+
+-- Ricerca per nome nella rubrica (/api/contacts?q=): indice FTS5 trigram sui display_name,
+-- tenuto allineato a contacts dai trigger (tabella external content, chiave = rowid)
+CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+  display_name, content='contacts', content_rowid='rowid', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_ai AFTER INSERT ON contacts
+BEGIN
+  INSERT INTO contacts_fts(rowid, display_name) VALUES (NEW.rowid, NEW.display_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_ad AFTER DELETE ON contacts
+BEGIN
+  INSERT INTO contacts_fts(contacts_fts, rowid, display_name) VALUES ('delete', OLD.rowid, OLD.display_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_fts_au AFTER UPDATE OF display_name ON contacts
+BEGIN
+  INSERT INTO contacts_fts(contacts_fts, rowid, display_name) VALUES ('delete', OLD.rowid, OLD.display_name);
+  INSERT INTO contacts_fts(rowid, display_name) VALUES (NEW.rowid, NEW.display_name);
+END;
+
+-- Versione della rubrica per utente, incrementata dai trigger a ogni scrittura su contacts:
+-- entra nella chiave della cache di /api/contacts, così ogni worker vede subito le modifiche
+CREATE TABLE IF NOT EXISTS contacts_version (
+  owner_user_id TEXT PRIMARY KEY,
+  version       INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_ai AFTER INSERT ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (NEW.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_ad AFTER DELETE ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (OLD.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
+
+-- un UPDATE può spostare il contatto da un utente all'altro: cambiano entrambe le rubriche
+CREATE TRIGGER IF NOT EXISTS trg_contacts_version_au AFTER UPDATE ON contacts
+BEGIN
+  INSERT INTO contacts_version (owner_user_id, version) VALUES (OLD.owner_user_id, 1)
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+  INSERT INTO contacts_version (owner_user_id, version)
+    SELECT NEW.owner_user_id, 1 WHERE NEW.owner_user_id IS NOT OLD.owner_user_id
+    ON CONFLICT(owner_user_id) DO UPDATE SET version = version + 1;
+END;
+
 -- Indici utili
-CREATE INDEX IF NOT EXISTS idx_accounts_user ON accounts(user_id);
 CREATE INDEX IF NOT EXISTS idx_piggy_user    ON piggy_banks(user_id);
-CREATE INDEX IF NOT EXISTS idx_trx_account   ON transactions(account_id);
-CREATE INDEX IF NOT EXISTS idx_trx_piggy     ON transactions(piggy_id);
+-- parziale: quasi tutti i movimenti hanno piggy_id NULL e non servono nell'indice
+CREATE INDEX IF NOT EXISTS idx_trx_piggy     ON transactions(piggy_id) WHERE piggy_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_trx_account_date_created ON transactions(account_id, date DESC, created_at DESC);
+-- coprente e parziale per il report (solo movimenti fuori dai salvadanai): piggy_id in coda
+-- serve solo a non far leggere la tabella al planner per verificare il filtro
+CREATE INDEX IF NOT EXISTS idx_trx_report ON transactions(account_id, date, type, category, amount, piggy_id)
+  WHERE piggy_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_accounts_user_created ON accounts(user_id, created_at DESC, account_id);
+-- parziale sui salvadanai non eliminati: stesso filtro delle query (status != 'DELETED'), già in ordine
+CREATE INDEX IF NOT EXISTS idx_piggy_user_active ON piggy_banks(user_id, created_at DESC) WHERE status != 'DELETED';
+CREATE INDEX IF NOT EXISTS idx_piggy_transfers_piggy ON piggy_transfers(piggy_id, direction, amount);
+CREATE INDEX IF NOT EXISTS idx_piggy_transfers_account_date ON piggy_transfers(account_id, date);
+CREATE INDEX IF NOT EXISTS idx_contacts_owner_target ON contacts(owner_user_id, target_user_id, target_account_id);
+CREATE INDEX IF NOT EXISTS idx_contacts_owner_created ON contacts(owner_user_id, created_at DESC, display_name);
 CREATE INDEX IF NOT EXISTS idx_split_groups_user ON split_groups(user_id);
 CREATE INDEX IF NOT EXISTS idx_split_members_group ON split_group_members(group_id);
 
@@ -138,6 +252,10 @@ CREATE TABLE IF NOT EXISTS notifications (
 CREATE INDEX IF NOT EXISTS idx_notifications_user   ON notifications(user_id);
 CREATE INDEX IF NOT EXISTS idx_notifications_status ON notifications(status);
 CREATE INDEX IF NOT EXISTS idx_notifications_dedupe ON notifications(dedupe_key);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_notifications_user_status  ON notifications(user_id, status, created_at DESC);
+-- una sola notifica per (utente, dedupe_key): vincolo usato dalla UPSERT di _ensure_notification
+CREATE UNIQUE INDEX IF NOT EXISTS uq_notifications_user_dedupe ON notifications(user_id, dedupe_key);
 
 -- Preferenze utente (valuta, formato numerico, soglie alert)
 CREATE TABLE IF NOT EXISTS user_settings (